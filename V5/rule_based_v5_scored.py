@@ -1,6 +1,16 @@
 import pandas as pd
 import numpy as np
 import logging
+import os
+import sys
+
+# Shared catalog modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instrumentation
+from compiled_rules import RULE_KINDS, get_compiled_rules
+from result_cache import ResultCache, body_score_band, unique_in_order
+from tag_index import difference, intersect, union
 
 disease_product_mapping = {
     # ===== METABOLIC/ENDOCRINE =====
@@ -465,183 +475,420 @@ disease_product_mapping = {
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def filter_by_condition(df, column, value):
-    """Filter DataFrame where `column` == `value` if column exists and has valid values."""
-    if column in df.columns and df[column].any():
-        filtered = df[df[column] == value]
-        if not filtered.empty:
-            logger.debug(f"Filtered by '{column}={value}': {len(filtered)} rows remaining")
-            return filtered
-    return df
-
-def filter_for_tags(df, disease_info,issue):
-    """Combine (union) DataFrames filtered by each 'for' tag individually."""
-    if 'for' not in disease_info or not disease_info['for']:
-        return df
-    for tag in disease_info['for']:
-        if tag in df.columns:
-            match_mask = df[tag] == 1
-            if issue == 'main_issue':
-                df.loc[match_mask, 'Score'] += 15
-            else: 
-                df.loc[match_mask, 'Score'] += 5
-    return df
-def filter_not_for_tags(df, disease_info,issue):
-    """Apply 'not_for' tag filters from disease_info."""
-    if 'not_for' in disease_info:
-        for tag in disease_info['not_for']:
-            match_mask = df[tag] == 0
-            if issue == 'main_issue':
-                df.loc[match_mask, 'Score'] += 15
-            else: 
-                df.loc[match_mask, 'Score'] += 5
-    return df
-def filter_type_tags(df, disease_info,issue):
-    """Apply 'type' tag filters from disease_info."""
-    if 'type' in disease_info:
-        for tag in disease_info['type']:
-            match_mask = df[tag] == 1
-            if issue == 'main_issue':
-                df.loc[match_mask, 'Score'] += 10
-            else:
-                df.loc[match_mask, 'Score'] += 5
-    return df
-
-def filter_category_tags(df, disease_info,issue):
-    """Optional: Apply 'category' tag filters from disease_info."""
-    if 'category' in disease_info:
-        for tag in disease_info['category']:
-            if tag in df.columns:
-              match_mask = df[tag] == 1
-              if issue == 'main_issue':
-                df.loc[match_mask, 'Score'] += 15
-              else:
-                df.loc[match_mask, 'Score'] += 5
-    return df
-def filter_has_tags(df, disease_info,issue):
-    """Optional: Apply 'has' tag filters from disease_info."""
-    if 'has' in disease_info:
-        for tag in disease_info['has']:
-            match_mask = df[tag] == 1
-            if issue == 'main_issue':
-                df.loc[match_mask, 'Score'] += 15
-            else:
-                df.loc[match_mask, 'Score'] += 5
-    return df
-
-def filter_life_stage(df, life_stage):
+# Points a matching tag adds, by disease entry kind, for the main issue and for other issues
+ISSUE_POINTS = {
+    'main_issue': {"for": 15, "not_for": 15, "type": 10, "category": 15, "has": 15},
+    'other_issues': {"for": 5, "not_for": 5, "type": 5, "category": 5, "has": 5},
+}
+CUSTOM_PRODUCT_POINTS = 20
+# Pets x products cells score_matrix scores at once (an int64 score and a bool mask per cell)
+SCORE_MATRIX_CELLS = 1 << 24
+
+# Results of recent pet profiles, shared by every caller of filter_products
+profile_cache = ResultCache(maxsize=4096, ttl=3600)
+# Points each disease adds to every catalog row, as main or other issue (2 bytes per row each)
+disease_vector_cache = ResultCache(maxsize=128)
+# Rows that pass the hard filters other than allergies, per candidate_key
+candidate_cache = ResultCache(maxsize=256)
+
+def filter_by_condition(rows, posting, exclude=False):
+    """Keep sorted `rows` found in `posting` (or not in it, with `exclude`), unless that would leave no rows."""
+    if posting is None:
+        return rows
+    filtered = difference(rows, posting) if exclude else intersect(rows, posting)
+    if len(filtered):
+        return filtered
+    instrumentation.fallback()
+    return rows
+
+def add_points(weights, rules, column, value, points):
+    """Add `points` for rows where `column` == `value` to `weights`; returns the constant part."""
+    j = rules.column_index[column]
+    if value == 1:
+        weights[j] += points
+        return 0
+    # x == 0 scores points * (1 - x) on a 0/1 column
+    weights[j] -= points
+    return points
+
+def add_disease_points(weights, rules, disease_info, issue):
+    """Add the points of every 'for'/'not_for'/'type'/'category'/'has' tag of a disease entry."""
+    points = ISSUE_POINTS[issue]
+    offset = 0
+    for kind in RULE_KINDS:
+        for tag in disease_info.get(kind, []):
+            # Only 'for' and 'category' tags are skipped when the catalog lacks the column
+            if kind in ("for", "category") and tag not in rules.column_index:
+                continue
+            offset += add_points(weights, rules, tag, 0 if kind == "not_for" else 1, points[kind])
+    return offset
+
+def disease_vector(rules, disease, issue, species=None):
+    """
+    Points `disease` adds to every catalog row as `issue` ('main_issue' or
+    'other_issues'), plus the custom product bonus of `species` for a main
+    issue. Built once per catalog and rule table, as int16 when it fits.
+    """
+    key = (disease, issue, species)
+    vector = disease_vector_cache.get(key, rules.generation)
+    if vector is None:
+        weights = np.zeros(len(rules.columns), dtype=np.int64)
+        offset = add_disease_points(weights, rules, disease_product_mapping[disease], issue)
+        points = rules.linear_scores(weights, offset)
+        if species is not None:
+            custom_rows = rules.diseases[disease].get(f"custom_{species}")
+            if custom_rows is not None:
+                points[custom_rows] += CUSTOM_PRODUCT_POINTS
+        fits = not len(points) or np.abs(points).max() < 2 ** 15
+        vector = points.astype(np.int16 if fits else np.int32)
+        vector.setflags(write=False)
+        disease_vector_cache.put(key, rules.generation, vector)
+    return vector
+
+def disease_vectors(pet, rules, main_issue=True):
+    """Cached point vectors of the pet's main issue (with its custom products) and each of its other issues."""
+    vectors = []
+    if main_issue and pet['main_issue'] in disease_product_mapping:
+        vectors.append(disease_vector(rules, pet['main_issue'], 'main_issue', pet['species'].lower()))
+    if pet['other_issues'] == 1:
+        for issue in pet['other_issues_list']:
+            if issue in disease_product_mapping:
+                vectors.append(disease_vector(rules, issue, 'other_issues'))
+    return vectors
+
+def add_issue_points(weights, rules, pet):
+    """Add the points of the pet's main and other issues to `weights`; returns the constant part."""
+    offset = 0
+    if pet['main_issue'] in disease_product_mapping:
+        offset += add_disease_points(weights, rules, disease_product_mapping[pet['main_issue']], 'main_issue')
+    if pet['other_issues'] == 1:
+        for issue in pet['other_issues_list']:
+            if issue in disease_product_mapping:
+                offset += add_disease_points(weights, rules, disease_product_mapping[issue], 'other_issues')
+    return offset
+
+def build_weight_vector(pet, rules):
+    """
+    Per-column weights and constant offset whose `matrix @ weights + offset`
+    is the V5 score without the disease points (see disease_vectors and add_issue_points).
+    """
+    weights = np.zeros(len(rules.columns), dtype=np.int64)
+    offset = 0
+
+    bds = pet['body score (bds)']
+    if bds >= 7:
+        offset += add_points(weights, rules, 'category_low calorie', 1, 5)
+    elif bds <= 3:
+        offset += add_points(weights, rules, 'for_appetite stimulation', 1, 10)
+        offset += add_points(weights, rules, 'not_for_overweight', 0, 10)
+        offset += add_points(weights, rules, 'not_for_catabolic states', 0, 5)
+        offset += add_points(weights, rules, 'category_high calorie', 1, 10)
+        offset += add_points(weights, rules, 'category_high protein', 1, 5)
+
+    offset += add_points(weights, rules, f'breed_size_{pet["breed_size"]}', 1, 5)
+    if pet['activity level'] == 'active':
+        offset += add_points(weights, rules, 'not_for_active pets', 0, 10)
+        offset += add_points(weights, rules, 'category_high calorie', 1, 5)
+        offset += add_points(weights, rules, 'category_energy-dense', 1, 5)
+    return weights, offset
+
+def filter_life_stage(rows, rules, life_stage):
     """Filter by life stage (growth/adult/senior)."""
     if life_stage in ['growth', 'adult', 'senior']:
-        life_stage_filter = (
-            (df[f'life_stage_{life_stage}'] == 1) |
-            (df['life_stage_all'] == 1) |
-            ((life_stage == 'senior') & (df['life_stage_adult'] == 1))
-        )
-        if life_stage_filter.any():
-            df = df[life_stage_filter]
-    return df
-
-def filter_products(df_pet_info, df_products):
-    """Main filtering logic for pet products."""
-    species_col = f"Species_{df_pet_info.iloc[0]['species']}"
-    df_filtered = filter_by_condition(df_products, species_col, 1)
-
-
-    # Filter by main issue (if any)
-    main_issue = df_pet_info.iloc[0]['main_issue'] 
-    if main_issue in disease_product_mapping:
-        disease_info = disease_product_mapping[main_issue]
-        logger.info(f"Filtering for main issue: {main_issue}")
-        df_filtered = filter_for_tags(df_filtered, disease_info,'main_issue')
-        df_filtered = filter_not_for_tags(df_filtered, disease_info,'main_issue')
-        df_filtered = filter_type_tags(df_filtered, disease_info,'main_issue')
-        df_filtered = filter_category_tags(df_filtered, disease_info,'main_issue')
-        df_filtered = filter_has_tags(df_filtered, disease_info,'main_issue')
-
-        # Check for custom products after main filtering
-        species = df_pet_info.iloc[0]['species'].lower()
-        custom_key = f"custom_{species}"
-        
-        if custom_key in disease_info and disease_info[custom_key]:
-            custom_products = disease_info[custom_key]
-            custom_mask = df_filtered['Product_id'].isin(custom_products)
-            df_filtered.loc[custom_mask, 'Score'] += 20
+        life_stage_columns = [f'life_stage_{life_stage}', 'life_stage_all']
+        if life_stage == 'senior':
+            life_stage_columns.append('life_stage_adult')
+        rows = filter_by_condition(rows, union([rules.postings(column) for column in life_stage_columns]))
+    return rows
+
+def skip_mark(stage, rows=None):
+    """Stand-in for instrumentation.mark in passes that must not record stages."""
+
+def filter_rows(pet, rules, allergen_columns, record=True):
+    """
+    Sorted rows that survive the filters which drop products rather than score them,
+    excluding the products of the `allergen_columns` ingredients. The filters run one
+    after the other on the pet's species shard when the catalog has one. Stages are
+    marked only with `record`, so a replay does not count them twice.
+    """
+    shard = rules.species_shard(pet['species'])
+    if shard is not None:
+        return shard.rows[filter_rows(pet, shard, allergen_columns, record)]
+    mark = instrumentation.mark if record else skip_mark
+    rows = rules.postings(f"Species_{pet['species']}")
+    if rows is None or not len(rows):
+        rows = rules.all_rows
+    mark('species', rows)
 
     # Filter by allergies
-    if df_pet_info.iloc[0]['allergy'] == 1:
-        for ingredient in df_pet_info.iloc[0]['allergic_to']:
-            if ingredient == 'unknown':
-                filter_by_condition(df_filtered, 'category_non-allergenic', 1)
-            else:
-                df_filtered = filter_by_condition(df_filtered, f'Ingredients_{ingredient}', 0)
-
-     # Filter by body score
-    bds = df_pet_info.iloc[0]['body score (bds)']
-    if bds >= 7: # >8 Means Obesity  and >7 Overweight
-        df_filtered = filter_by_condition(df_filtered, 'for_weight management', 1)
-        df_filtered = filter_by_condition(df_filtered, 'not_for_overweight', 0)
-        mask = df_filtered['category_low calorie'] == 1
-        df_filtered.loc[mask, 'Score'] += 5
+    if allergen_columns:
+        for column in allergen_columns:
+            rows = filter_by_condition(rows, rules.postings(column), exclude=True)
+        mark('allergies', rows)
 
+    # Filter by body score
+    bds = pet['body score (bds)']
+    if bds >= 7: # >8 Means Obesity  and >7 Overweight
+        rows = filter_by_condition(rows, rules.postings('for_weight management'))
+        rows = filter_by_condition(rows, rules.postings('not_for_overweight'), exclude=True)
     elif bds <= 3: # Means Underweight
-        df_filtered = filter_by_condition(df_filtered, 'for_weight management', 0)
-        mask = df_filtered['for_appetite stimulation'] == 1
-        df_filtered.loc[mask, 'Score'] += 10
-        mask = df_filtered['not_for_overweight'] == 0
-        df_filtered.loc[mask, 'Score'] += 10
-        mask = df_filtered['not_for_catabolic states'] == 0
-        df_filtered.loc[mask, 'Score'] += 5
-        mask = df_filtered['category_high calorie'] == 1
-        df_filtered.loc[mask, 'Score'] += 10
-        mask = df_filtered['category_high protein'] == 1
-        df_filtered.loc[mask, 'Score'] += 5
-
+        rows = filter_by_condition(rows, rules.postings('for_weight management'), exclude=True)
+    mark('body_score', rows)
 
     # Filter by pregnancy/lactation
-    if df_pet_info.iloc[0]['pregnant']:
+    if pet['pregnant']:
         life_stage = 'growth'
-        df_filtered = filter_by_condition(df_filtered, 'not_for_pregnancy', 0)
+        rows = filter_by_condition(rows, rules.postings('not_for_pregnancy'), exclude=True)
 
-    if df_pet_info.iloc[0]['lactating']:
+    if pet['lactating']:
         life_stage = 'growth'
-        df_filtered = filter_by_condition(df_filtered, 'not_for_lactation', 0)
+        rows = filter_by_condition(rows, rules.postings('not_for_lactation'), exclude=True)
+    mark('reproduction', rows)
 
     # Filter by life stage
-    if not (df_pet_info.iloc[0]['pregnant'] or df_pet_info.iloc[0]['lactating']):
-       life_stage = df_pet_info.iloc[0]['life_stage']
-    df_filtered = filter_life_stage(df_filtered, life_stage)
+    if not (pet['pregnant'] or pet['lactating']):
+       life_stage = pet['life_stage']
+    rows = filter_life_stage(rows, rules, life_stage)
+    mark('life_stage', rows)
+    return rows
 
-    # Filter by other issues
-    if df_pet_info.iloc[0]['other_issues'] == 1:
-        for issue in df_pet_info.iloc[0]['other_issues_list']:
-            if issue in disease_product_mapping:
-                disease_info = disease_product_mapping[issue]
-                df_filtered = filter_for_tags(df_filtered, disease_info,'other_issues')
-                df_filtered = filter_not_for_tags(df_filtered, disease_info,'other_issues')
-                df_filtered = filter_type_tags(df_filtered, disease_info,'other_issues')
-                df_filtered = filter_category_tags(df_filtered, disease_info,'other_issues')
-                df_filtered = filter_has_tags(df_filtered, disease_info,'other_issues')
+def candidate_rows(pet, rules):
+    """
+    Read-only rows that pass the hard filters other than allergies, computed once
+    per candidate_key. A computed set records the filter stages, a cached one 'candidates'.
+    """
+    key = candidate_key(pet)
+    rows = candidate_cache.get(key, rules.generation)
+    if rows is None:
+        rows = filter_rows(pet, rules, ()).view()
+        rows.setflags(write=False)
+        candidate_cache.put(key, rules.generation, rows)
+    else:
+        instrumentation.mark('candidates', rows)
+    return rows
+
+def hard_filter_rows(pet, rules):
+    """
+    Sorted rows that survive the filters which drop products rather than score them:
+    the pet's candidate set without the products of its allergies.
+    """
+    allergic_to = allergy_names(pet)
+    rows = candidate_rows(pet, rules)
+    if allergic_to:
+        rows = rules.ingredients.exclude(rows, allergic_to)
+        # Every filter keeps its rows when it would leave none. With rows left, none of them did,
+        # and the filters commute; otherwise only running them in order tells which one kept its rows.
+        # The replay belongs to this stage, so it marks none of its own
+        if not len(rows):
+            rows = filter_rows(pet, rules, rules.ingredients.columns_of(allergic_to), record=False)
+        instrumentation.mark('allergies', rows)
+    return rows
+
+def rank_by_score(score):
+    """Positions of `score` from highest to lowest, ordered like DataFrame.sort_values('Score', ascending=False)."""
+    reversed_positions = np.arange(len(score))[::-1]
+    return reversed_positions[score[::-1].argsort(kind='quicksort')][::-1]
+
+def top_k_by_score(rows, score, k, rules):
+    """Positions of the `k` best scores, ties broken by ascending Product_id, without a full sort."""
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    # One integer key: higher score first, then the smaller Product_id
+    key = score * rules.n_rows + (rules.n_rows - 1 - rules.product_id_rank[rows])
+    if k < len(key):
+        best = np.argpartition(-key, k - 1)[:k]
+    else:
+        best = np.arange(len(key))
+    return best[np.argsort(-key[best])]
+
+def ranked_products(rows, score, rules, top_k=None):
+    """(Product_id, Score) pairs for `rows`, best first; only the `top_k` best when given."""
+    order = rank_by_score(score) if top_k is None else top_k_by_score(rows, score, top_k, rules)
+    rows, score = rows[order], score[order]
+    return list(zip(rules.product_ids[rows].tolist(), score.tolist()))
+
+def score_rows(pet, rules):
+    """Rows that pass the hard filters, in catalog order, and their scores."""
+    main_issue = pet['main_issue']
+    if main_issue in disease_product_mapping:
+        logger.info(f"Filtering for main issue: {main_issue}")
+    weights, offset = build_weight_vector(pet, rules)
+    instrumentation.mark('weights')
+
+    rows = hard_filter_rows(pet, rules)
+    score = rules.linear_scores(weights, offset, rows)
+    # Main and other issue points, custom product bonus included
+    for vector in disease_vectors(pet, rules):
+        score += vector[rows]
+    instrumentation.mark('score', rows)
+    return rows, score
+
+def filter_products(df_pet_info, df_products, rules=None, top_k=None, cache=profile_cache, table=None):
+    """
+    Main filtering logic for pet products.
+    The catalog is only read: scores live in an array owned by this call, so
+    concurrent requests can share one catalog without copies or locks.
+    With `top_k`, only the k best products are returned (ties by Product_id);
+    the count is still the number of products that passed the filters.
+    Results are served from `cache` when it has them, and scores from a
+    materialized recommendation `table` built for the same catalog and rules.
+    """
+    if rules is None:
+        rules = get_compiled_rules(df_products, disease_product_mapping)
+    pet = df_pet_info.iloc[0]
+    if cache is not None:
+        key = (profile_key(pet), top_k)
+        cached = cache.get(key, rules.generation)
+        if cached is not None:
+            scored_products, count = cached
+            return list(scored_products), count
+
+    with instrumentation.request('v5'):
+        scored = None
+        if table is not None and table.serves(rules):
+            scored = table_scores(pet, rules, table)
+        rows, score = scored if scored is not None else score_rows(pet, rules)
+
+        # Return both IDs and scores (as list of tuples), best first
+        scored_products = ranked_products(rows, score, rules, top_k)
+        instrumentation.mark('rank', scored_products)
+
+    if cache is not None:
+        cache.put(key, rules.generation, (tuple(scored_products), len(rows)))
+    return scored_products, len(rows)
+
+
+def allergy_names(pet):
+    """
+    The pet's allergies in order, without repeats and without 'unknown', which
+    has never narrowed the result (its filter_by_condition result was discarded).
+    """
+    if pet['allergy'] != 1:
+        return ()
+    return unique_in_order(a for a in pet['allergic_to'] if a != 'unknown')
+
+def candidate_key(pet):
+    """The pet fields the hard filters other than allergies read: species, body score band, reproduction, life stage."""
+    pregnant, lactating = bool(pet['pregnant']), bool(pet['lactating'])
+    life_stage = 'growth' if (pregnant or lactating) else pet['life_stage']
+    return (pet['species'], body_score_band(pet['body score (bds)']), pregnant, lactating, life_stage)
+
+def hard_filter_key(pet):
+    """
+    The pet fields hard_filter_rows reads, so pets sharing them can share one
+    result. Allergy order is kept (the exclusions fall back).
+    """
+    return candidate_key(pet) + (allergy_names(pet),)
+
+def table_key(pet, diseases=disease_product_mapping):
+    """The pet fields score_rows reads apart from allergies and other issues, canonicalised."""
+    pregnant, lactating = bool(pet['pregnant']), bool(pet['lactating'])
+    return (
+        pet['species'],
+        pet['main_issue'] if pet['main_issue'] in diseases else None,
+        body_score_band(pet['body score (bds)']),
+        pregnant,
+        lactating,
+        'growth' if (pregnant or lactating) else pet['life_stage'],
+        pet['breed_size'],
+        pet['activity level'] == 'active',
+    )
+
+def materialize(pet, rules):
+    """Arrays a recommendation table stores for a profile without allergies or other issues."""
+    rows, score = score_rows(pet, rules)
+    return {'rows': rows, 'scores': score}
+
+def table_scores(pet, rules, table):
+    """
+    Rows and scores from a materialized table for a pet without allergies;
+    other issues only add points, so they are added to the stored scores.
+    None when the table does not hold the pet's profile.
+    """
+    if allergy_names(pet):
+        return None
+    entry = table.get('full', table_key(pet))
+    if entry is None:
+        return None
+    rows, score = entry['rows'], entry['scores'].astype(np.int64)
+    for vector in disease_vectors(pet, rules, main_issue=False):
+        score += vector[rows]
+    return rows, score
 
-    # Filter by breed size and activity level
-    mask = df_filtered[f'breed_size_{df_pet_info.iloc[0]["breed_size"]}'] == 1
-    df_filtered.loc[mask, 'Score'] += 5
+def profile_key(pet):
+    """
+    Every pet field filter_products reads, canonicalised so that profiles with
+    the same result share a key. Other issues only add points, so their order
+    does not matter.
+    """
+    main_issue = pet['main_issue'] if pet['main_issue'] in disease_product_mapping else None
+    other_issues = ()
+    if pet['other_issues'] == 1:
+        other_issues = tuple(sorted(i for i in pet['other_issues_list'] if i in disease_product_mapping))
+    return hard_filter_key(pet) + (main_issue, other_issues, pet['breed_size'], pet['activity level'] == 'active')
 
-    # if df_pet_info['activity level'] == 'Active':
-    activity_level = df_pet_info.iloc[0]['activity level']
-    if activity_level == 'active':
-        mask = df_filtered['not_for_active pets'] == 0
-        df_filtered.loc[mask, 'Score'] += 10
+def score_matrix(pets, rules):
+    """Pets x products scores and hard-filter masks for a list of pet profiles."""
+    weights = np.zeros((len(pets), len(rules.columns)), dtype=np.int64)
+    offsets = np.zeros(len(pets), dtype=np.int64)
+    alive = np.zeros((len(pets), rules.n_rows), dtype=bool)
+    hard_filters = {}
+    custom = []
+    for i, pet in enumerate(pets):
+        # One matmul scores the whole batch, so disease points ride along in the weights
+        weights[i], offsets[i] = build_weight_vector(pet, rules)
+        offsets[i] += add_issue_points(weights[i], rules, pet)
+        key = hard_filter_key(pet)
+        if key not in hard_filters:
+            hard_filters[key] = hard_filter_rows(pet, rules)
+        alive[i, hard_filters[key]] = True
+        if pet['main_issue'] in rules.diseases:
+            custom_rows = rules.diseases[pet['main_issue']].get(f"custom_{pet['species'].lower()}")
+            if custom_rows is not None:
+                custom.append((i, custom_rows))
 
-        mask = df_filtered['category_high calorie'] == 1
-        df_filtered.loc[mask, 'Score'] += 5
+    scores = rules.linear_scores_batch(weights, offsets)
+    for i, custom_rows in custom:
+        scores[i, custom_rows] += CUSTOM_PRODUCT_POINTS
+    return scores, alive
 
-        mask = df_filtered['category_energy-dense'] == 1
-        df_filtered.loc[mask, 'Score'] += 5
+def score_batch_size(rules):
+    """Pets scored as one matrix so that it holds at most SCORE_MATRIX_CELLS cells, whatever the catalog size."""
+    return max(1, SCORE_MATRIX_CELLS // max(rules.n_rows, 1))
 
-    # Get sorted products with scores
-    sorted_df = df_filtered.sort_values('Score', ascending=False)
+def recommend_batch(df_pets, df_products, rules=None, batch_size=None, top_k=None):
+    """
+    Ranked (Product_id, Score) lists for every row of df_pets, same as filter_products per row.
+    Pets are scored `batch_size` at a time, by default as many as score_batch_size allows.
+    """
+    if rules is None:
+        rules = get_compiled_rules(df_products, disease_product_mapping)
+    if batch_size is None:
+        batch_size = score_batch_size(rules)
+    pets = df_pets.to_dict('records')
+    recommendations = []
+    for start in range(0, len(pets), batch_size):
+        batch = recommend_records(pets[start:start + batch_size], rules, top_k)
+        recommendations.extend(products for products, _ in batch)
+        logger.debug(f"Scored pets {start}-{start + len(batch)} of {len(pets)}")
+    return recommendations
 
-    # Return both IDs and scores (as list of tuples)
-    scored_products = list(zip(sorted_df['Product_id'], sorted_df['Score']))
+def recommend_records(pets, rules, top_k=None):
+    """(ranked (Product_id, Score) list, number of products that passed) for each pet profile dict, scored as one matrix."""
+    scores, alive = score_matrix(pets, rules)
+    results = []
+    for pet_scores, pet_alive in zip(scores, alive):
+        rows = np.flatnonzero(pet_alive)
+        results.append((ranked_products(rows, pet_scores[rows], rules, top_k), len(rows)))
+    return results
 
-    return scored_products, len(scored_products)
+def add_recommendations_to_pets(pet_info_df, df_products, rules=None):
+    """
+    Adds scored product recommendations to a copy of the pet table.
+    Each row gets its ranked (Product_id, Score) list and the number of products.
+    """
+    recommendations = recommend_batch(pet_info_df, df_products, rules)
+    pet_info_df = pet_info_df.copy()
+    pet_info_df['Recommended_Products'] = recommendations
+    pet_info_df['Recommendations_Count'] = [len(products) for products in recommendations]
+    return pet_info_df
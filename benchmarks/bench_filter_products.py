@@ -0,0 +1,225 @@
+"""
+Latency, throughput and peak-memory benchmark for the v3 and V5 filter_products.
+
+Every (engine, catalog) case runs in its own process so peak RSS is per case.
+Results are written as JSON tagged with the git commit, and --compare prints
+the ratio against an earlier results file. --stages adds the per-stage time and
+survivor histograms of the instrumentation module.
+
+    python benchmarks/bench_filter_products.py --sizes 10000 100000 -o bench.json
+    python benchmarks/bench_filter_products.py --compare bench.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import instrumentation
+from catalog import file_version, load_catalog
+from recommendation_table import engine_module
+from synthetic_catalog import generate_catalog
+
+REAL_CATALOG = os.path.join(ROOT, "encoded_all_products.csv")
+CACHE_DIR = os.path.join(ROOT, "benchmarks", ".cache")
+ENGINES = ["v3", "v5"]
+
+LIFE_STAGES = ["growth", "adult", "senior"]
+BODY_SCORES = [1, 3, 5, 7, 9]
+BREED_SIZES = ["small", "medium", "large"]
+ACTIVITY_LEVELS = ["active", "not active", "Active"]
+ALLERGY_SETS = [[], ["chicken"], ["unknown"], ["beef", "corn"], ["sweet potato", "fava beans", "duck liver"], ["dairy"]]
+# (pregnant, lactating)
+REPRODUCTIVE_STATES = [(False, False), (False, False), (True, False), (False, True), (True, True)]
+
+
+def pet_corpus(disease_keys):
+    """
+    Fixed pet profiles: every disease key as main issue for both species, plus
+    profiles with no main issue. The other fields cycle through every life
+    stage, body score, breed size, activity level, allergy set and
+    pregnancy/lactation state so each value is exercised.
+    """
+    main_issues = list(disease_keys) + ["-- select main issue --"] * 10
+    fields = zip(
+        itertools.cycle(LIFE_STAGES),
+        itertools.cycle(BODY_SCORES),
+        itertools.cycle(BREED_SIZES),
+        itertools.cycle(ACTIVITY_LEVELS),
+        itertools.cycle(ALLERGY_SETS),
+        itertools.cycle(REPRODUCTIVE_STATES),
+        itertools.cycle([[], [], [disease_keys[0]], disease_keys[-2:]]),
+    )
+    profiles = []
+    for (species, main_issue), (life_stage, bds, breed_size, activity, allergies, (pregnant, lactating), other) in zip(
+            itertools.product(["Dog", "Cat"], main_issues), fields):
+        profiles.append({
+            "species": species,
+            "life_stage": life_stage,
+            "weight": 10.0,
+            "age (months)": 24,
+            "activity level": activity,
+            "main_issue": main_issue,
+            "other_issues": int(bool(other)),
+            "other_issues_list": other,
+            "gender": "female" if (pregnant or lactating) else "male",
+            "breed": "-- Select a breed --",
+            "breed_size": breed_size,
+            "body score (bds)": bds,
+            "pregnant": pregnant,
+            "lactating": lactating,
+            "allergy": int(bool(allergies)),
+            "allergic_to": allergies,
+        })
+    return profiles
+
+
+def synthetic_catalog_path(n_rows, seed=0):
+    """Synthetic binary catalog of `n_rows` products learned from the real one, built once and cached."""
+    path = os.path.join(CACHE_DIR, f"synthetic_{n_rows}_{seed}_{file_version(REAL_CATALOG)}.ovcat")
+    if not os.path.exists(path):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        generate_catalog(REAL_CATALOG, path, n_rows, seed)
+    return path
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB."""
+    # ru_maxrss survives exec, so a spawned worker would report the parent's peak;
+    # VmHWM starts over with the new address space
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_case(engine, catalog_path, repeat, max_calls, stages=False, cache=False, sparse=False):
+    """Time one engine over the corpus on one catalog (runs in a fresh process)."""
+    logging.disable(logging.INFO)
+    module = engine_module(engine)
+    started = time.perf_counter()
+    catalog = load_catalog(catalog_path, sparse)
+    # First call compiles the rules for this catalog
+    profiles = pet_corpus(list(module.disease_product_mapping))[:max_calls]
+    pet_frames = [pd.DataFrame([profile]) for profile in profiles]
+    # The profile result cache would turn every repeat into a lookup
+    options = {} if cache else {"cache": None}
+    module.filter_products(pet_frames[0], catalog, **options)
+    load_seconds = time.perf_counter() - started
+
+    if stages:
+        instrumentation.enable()
+    latencies = []
+    loop_started = time.perf_counter()
+    for _ in range(repeat):
+        for df_pet_info in pet_frames:
+            call_started = time.perf_counter_ns()
+            module.filter_products(df_pet_info, catalog, **options)
+            latencies.append(time.perf_counter_ns() - call_started)
+    elapsed = time.perf_counter() - loop_started
+
+    latencies_ms = np.array(latencies) / 1e6
+    result = {
+        "engine": engine,
+        "catalog": os.path.basename(catalog_path),
+        "rows": catalog.n_rows,
+        "sparse": sparse,
+        "calls": len(latencies),
+        "load_compile_s": round(load_seconds, 4),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 4),
+        "throughput_per_s": round(len(latencies) / elapsed, 1),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if stages:
+        result["stages"] = instrumentation.snapshot()[engine]
+        result["stage_report"] = instrumentation.report()
+    return result
+
+
+def environment():
+    """Commit and library versions the results were measured with."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def print_results(results, baseline=None):
+    """Print a results table, with p50/throughput ratios against `baseline` if given."""
+    previous = {(r["engine"], r["rows"]): r for r in (baseline or [])}
+    print(f"{'engine':<6} {'rows':>9} {'calls':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'calls/s':>10} {'peak MB':>8}")
+    for r in results:
+        line = (f"{r['engine']:<6} {r['rows']:>9} {r['calls']:>6} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} "
+                f"{r['p99_ms']:>9.3f} {r['throughput_per_s']:>10.1f} {r['peak_rss_mb']:>8.1f}")
+        old = previous.get((r["engine"], r["rows"]))
+        if old:
+            line += f"   p50 x{r['p50_ms'] / old['p50_ms']:.2f}  throughput x{r['throughput_per_s'] / old['throughput_per_s']:.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES)
+    parser.add_argument("--sizes", nargs="*", type=int, default=[10_000, 100_000, 1_000_000],
+                        help="synthetic catalog sizes to run besides the real catalog")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the pet corpus per case")
+    parser.add_argument("--max-calls", type=int, default=10_000, help="cap on corpus profiles per pass")
+    parser.add_argument("-o", "--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    parser.add_argument("--stages", action="store_true", help="also record per-stage time and survivor counts")
+    parser.add_argument("--cache", action="store_true", help="keep the engines' profile result cache on")
+    parser.add_argument("--sparse", action="store_true", help="load catalogs with sparse tags")
+    args = parser.parse_args()
+
+    catalogs = [REAL_CATALOG] + [synthetic_catalog_path(n) for n in args.sizes]
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for catalog_path, engine in itertools.product(catalogs, args.engines):
+        print(f"running {engine} on {os.path.basename(catalog_path)} ...", file=sys.stderr)
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_case, (engine, catalog_path, args.repeat, args.max_calls, args.stages, args.cache,
+                                                 args.sparse)))
+        if args.stages:
+            print(results[-1].pop("stage_report"), file=sys.stderr)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
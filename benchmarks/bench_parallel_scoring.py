@@ -0,0 +1,146 @@
+"""
+Scaling benchmark for multiprocess batch scoring with a shared-memory catalog.
+
+Scores the same pet CSV with 1, 2, 4, ... worker processes and reports pets/s,
+speedup over one worker and parallel efficiency (speedup / workers). Memory is
+the peak total PSS of the runner and its workers, which counts shared pages
+once: a catalog copied into every worker would grow it with the worker count.
+
+    python benchmarks/bench_parallel_scoring.py --engine v5 --size 100000 --pets 20000 -o scaling.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_filter_products import CACHE_DIR, REAL_CATALOG, environment, pet_corpus, synthetic_catalog_path
+from recommendation_table import engine_module
+import score_pets
+
+
+def pet_csv_path(n_pets):
+    """Pet CSV of `n_pets` rows cycling through the benchmark pet corpus, built once and cached."""
+    path = os.path.join(CACHE_DIR, f"pets_{n_pets}.csv")
+    if not os.path.exists(path):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        corpus = pet_corpus(list(engine_module("v5").disease_product_mapping))
+        rows = []
+        for i in range(n_pets):
+            pet = corpus[i % len(corpus)]
+            row = {field: json.dumps(value) if isinstance(value, list) else value for field, value in pet.items()}
+            row["pet_id"] = f"pet{i}"
+            rows.append(row)
+        pd.DataFrame(rows).to_csv(path, index=False)
+    return path
+
+
+def process_tree(pid):
+    """`pid` and all its descendants."""
+    pids = [pid]
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children = f.read().split()
+        except OSError:
+            continue
+        for child in children:
+            pids.extend(process_tree(int(child)))
+    return pids
+
+
+def total_pss_mb(pid):
+    """Summed proportional set size of a process tree in MB, or None where /proc has no smaps_rollup."""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/smaps_rollup") as f:
+                total += sum(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+        except OSError:
+            if member == pid:
+                return None
+    return total / 1024
+
+
+def run_case(pets_path, catalog_path, engine, workers, chunk_size):
+    """Score the pet file once, sampling the memory of this process and its workers."""
+    peak = [0.0]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            pss = total_pss_mb(os.getpid())
+            if pss is None:
+                return
+            peak[0] = max(peak[0], pss)
+            time.sleep(0.05)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        summary = score_pets.score_pets(pets_path, os.path.join(tmp, "results.jsonl"), engine, catalog_path,
+                                        chunk_size, top_k=10, workers=workers)
+    done.set()
+    sampler.join()
+    summary.pop("output")
+    summary["peak_pss_mb"] = round(peak[0], 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engine", choices=["v3", "v5"], default="v5")
+    parser.add_argument("--size", type=int, default=100_000, help="synthetic catalog size (0 for the real catalog)")
+    parser.add_argument("--pets", type=int, default=20_000)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--workers", nargs="+", type=int,
+                        help="worker counts to run (default: 1, 2, 4, ... up to the CPU count)")
+    parser.add_argument("-o", "--output", help="write results as JSON to this file")
+    parser.add_argument("--case", nargs=5, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        pets_path, catalog_path, engine, workers, chunk_size = args.case
+        print(json.dumps(run_case(pets_path, catalog_path, engine, int(workers), int(chunk_size))))
+        return
+
+    cpus = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({n for n in (1, 2, 4, 8, 16, 32, 64) if n <= cpus} | {cpus})
+    if max(worker_counts) > cpus:
+        print(f"warning: {max(worker_counts)} workers on {cpus} CPUs cannot scale past {cpus}", file=sys.stderr)
+    catalog_path = synthetic_catalog_path(args.size) if args.size else REAL_CATALOG
+    pets_path = pet_csv_path(args.pets)
+
+    results = []
+    for workers in worker_counts:
+        print(f"running {args.engine} with {workers} workers ...", file=sys.stderr)
+        # A fresh interpreter per case, so memory and warm caches do not carry over
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", pets_path, catalog_path,
+                                 args.engine, str(workers), str(args.chunk_size)],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    # Throughput per worker of the smallest run is the linear-scaling reference
+    base = results[0]["pets_per_s"] / results[0]["workers"]
+    print(f"{'workers':>7} {'pets/s':>10} {'speedup':>8} {'efficiency':>10} {'peak PSS MB':>12}")
+    for r in results:
+        r["speedup"] = round(r["pets_per_s"] / base, 2)
+        r["efficiency"] = round(r["speedup"] / r["workers"], 2)
+        print(f"{r['workers']:>7} {r['pets_per_s']:>10.1f} {r['speedup']:>8.2f} {r['efficiency']:>10.2f} "
+              f"{r['peak_pss_mb']:>12.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "engine": args.engine, "catalog": os.path.basename(catalog_path),
+                       "pets": args.pets, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
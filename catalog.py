@@ -0,0 +1,597 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+
+import numpy as np
+import pandas as pd
+
+from tag_index import SparseTags
+
+logger = logging.getLogger(__name__)
+
+# Binary catalog layout: MAGIC, uint32 format version, uint32 header length, a JSON
+# header, then 64-byte aligned sections (column-major uint8 tag matrix, one
+# NUL-separated UTF-8 string table per text column)
+MAGIC = b"OVETCAT\0"
+FORMAT_VERSION = 1
+CATALOG_SUFFIX = ".ovcat"
+SECTION_ALIGN = 64
+# Catalog schema: these columns hold product strings, every other column is a 0/1 tag
+TEXT_COLUMNS = ["Brand", "Product_id", "Product_Name", "Product"]
+# String columns with few distinct values, returned as categoricals by Catalog.frame()
+CATEGORICAL_COLUMNS = ["Brand"]
+# Rows parsed at a time when reading an encoded products CSV
+CSV_CHUNK_ROWS = 100_000
+# Rows hashed at a time when a catalog without version is identified by its content
+DIGEST_CHUNK_ROWS = 65_536
+# Load catalogs with sparse tags by default; set OVET_SPARSE_CATALOG=1 for wide, mostly-zero catalogs
+SPARSE_DEFAULT = os.environ.get("OVET_SPARSE_CATALOG", "") not in ("", "0")
+
+
+class Catalog:
+    """
+    Encoded product catalog: a uint8 tag matrix (one column per tag, validated
+    to hold only 0 and 1) plus the product string columns of TEXT_COLUMNS.
+    The tags are kept either dense or, for a sparse catalog, as SparseTags
+    (the rows of each column that are 1); rows, versions and results are the
+    same either way.
+
+    Catalogs are immutable snapshots. updated() makes the next snapshot after
+    product upserts and deletes: upserted products keep their row, new ones are
+    appended and deleted rows stay behind as tombstones (`dead`), so row
+    positions, and with them result order, match a catalog rebuilt from the
+    edited CSV. A snapshot shares the tag matrix of the catalog it came from and
+    keeps only the rows written since in `patch` (rows `patch_rows`).
+    """
+
+    def __init__(self, column_order, columns, matrix, strings, version=None, patch_rows=None, patch=None, dead=None):
+        self.column_order = list(column_order)
+        self.columns = list(columns)
+        self.strings = strings
+        self.version = version
+        self.product_ids = strings['Product_id']
+        self.n_rows = len(self.product_ids)
+        self._base = matrix
+        self.sparse = isinstance(matrix, SparseTags)
+        self.patch_rows = patch_rows if patch_rows is not None else np.empty(0, dtype=np.int64)
+        self.patch = patch if patch is not None else np.empty((0, len(self.columns)), dtype=np.uint8)
+        self.dead = dead if dead is not None else np.empty(0, dtype=np.int64)
+        unpatched = not len(self.patch_rows) and matrix.shape[0] == self.n_rows
+        self._dense = matrix if unpatched and not self.sparse else None
+        self._frame = None
+        self._id_index = None
+        # Rules compiled for this catalog, by id of their rule table (see compiled_rules.get_compiled_rules).
+        # They refer back to the catalog, so both go away together once nothing else holds the catalog
+        self.compiled_rules = {}
+        # Catalogs are shared between sessions and threads, so their arrays are read-only
+        for values in [self.patch_rows, self.patch, self.dead] + list(self.strings.values()):
+            values.setflags(write=False)
+        if not self.sparse:
+            matrix.setflags(write=False)
+
+    @classmethod
+    def from_frame(cls, df_products, version=None, sparse=False):
+        """Split an encoded products DataFrame into tag matrix (dense or sparse) and string columns."""
+        columns = tag_columns(df_products.columns)
+        matrix = np.asfortranarray(tag_matrix(df_products[columns]))
+        if sparse:
+            matrix = SparseTags.from_dense(matrix)
+        # Copied, so freezing the catalog's arrays never freezes the caller's frame
+        strings = {
+            column: df_products[column].fillna('').to_numpy(dtype=object, copy=True)
+            for column in df_products.columns if column not in columns
+        }
+        return cls(df_products.columns, columns, matrix, strings, version)
+
+    @property
+    def matrix(self):
+        """
+        Dense tag matrix over every row; assembled once for a snapshot with
+        patched rows or a sparse catalog (which then holds it in full).
+        """
+        if self._dense is None:
+            dense = np.zeros((self.n_rows, len(self.columns)), dtype=np.uint8, order='F')
+            dense[:self._base.shape[0]] = self._base.toarray() if self.sparse else self._base
+            dense[self.patch_rows] = self.patch
+            dense.setflags(write=False)
+            self._dense = dense
+        return self._dense
+
+    def features(self, active, rows=None):
+        """Tag columns `active` over all rows or only `rows`, without assembling a patched matrix."""
+        if self._dense is not None:
+            return self._dense[:, active] if rows is None else self._dense[np.ix_(rows, active)]
+        if rows is None:
+            features = np.zeros((self.n_rows, len(active)), dtype=np.uint8)
+            features[:self._base.shape[0]] = self._base_features(active)
+            features[self.patch_rows] = self.patch[:, active]
+            return features
+        positions = np.minimum(np.searchsorted(self.patch_rows, rows), max(len(self.patch_rows) - 1, 0))
+        patched = self.patch_rows[positions] == rows if len(self.patch_rows) else np.zeros(len(rows), dtype=bool)
+        features = np.empty((len(rows), len(active)), dtype=np.uint8)
+        features[~patched] = self._base_features(active, rows[~patched])
+        features[patched] = self.patch[np.ix_(positions[patched], active)]
+        return features
+
+    def _base_features(self, active, rows=None):
+        if self.sparse:
+            return self._base.features(active, rows)
+        return self._base[:, active] if rows is None else self._base[np.ix_(rows, active)]
+
+    def sparse_tags(self):
+        """SparseTags of every row, patches applied, or None for a dense catalog."""
+        if not self.sparse:
+            return None
+        if not len(self.patch_rows) and self._base.n_rows == self.n_rows:
+            return self._base
+        return self._base.with_rows(self.n_rows, self.patch_rows, self.patch)
+
+    def content_version(self):
+        """Hash of the tags and Product_ids, for catalogs built from a DataFrame, which carry no version."""
+        # Rows are hashed a block at a time in row-major order, the same bytes for dense and sparse tags
+        digest = hashlib.sha256()
+        all_columns = np.arange(len(self.columns))
+        for start in range(0, self.n_rows, DIGEST_CHUNK_ROWS):
+            rows = np.arange(start, min(start + DIGEST_CHUNK_ROWS, self.n_rows))
+            digest.update(np.ascontiguousarray(self.features(all_columns, rows)).tobytes())
+        digest.update('\0'.join(self.product_ids).encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+    def live_rows(self):
+        """Row positions that hold a product, i.e. all but the tombstones."""
+        if not len(self.dead):
+            return np.arange(self.n_rows)
+        live = np.ones(self.n_rows, dtype=bool)
+        live[self.dead] = False
+        return np.flatnonzero(live)
+
+    def frame(self):
+        """DataFrame view of the catalog in the original column order (built once)."""
+        if self._frame is None:
+            column_index = {column: j for j, column in enumerate(self.columns)}
+            rows = self.live_rows() if len(self.dead) else slice(None)
+            data = {}
+            for column in self.column_order:
+                if column in CATEGORICAL_COLUMNS:
+                    data[column] = pd.Categorical(self.strings[column][rows])
+                elif column in self.strings:
+                    data[column] = self.strings[column][rows]
+                else:
+                    data[column] = self.features([column_index[column]])[rows, 0]
+            self._frame = pd.DataFrame(data)
+        return self._frame
+
+    def compacted(self):
+        """The same products as a plain catalog: tombstones dropped, patched rows written into one matrix."""
+        if not len(self.patch_rows) and self._base.shape[0] == self.n_rows and not len(self.dead):
+            return self
+        rows = self.live_rows()
+        if self.sparse:
+            matrix = self.sparse_tags().take(rows)
+        else:
+            matrix = np.asfortranarray(self.matrix[rows])
+        strings = {column: values[rows] for column, values in self.strings.items()}
+        # Rows move, so results keyed by version must not carry over
+        version = hashlib.sha256(f"{self.version}:compacted".encode('utf-8')).hexdigest()[:16]
+        return Catalog(self.column_order, self.columns, matrix, strings, version)
+
+    def id_index(self):
+        """(row order by Product_id, Product_ids in that order), built once and carried into updated snapshots."""
+        if self._id_index is None:
+            order = np.argsort(self.product_ids, kind='stable')
+            self._id_index = (order, self.product_ids[order])
+        return self._id_index
+
+    def rows_of_ids(self, product_ids):
+        """Live row of each Product_id, -1 for ids not in the catalog."""
+        order, sorted_ids = self.id_index()
+        product_ids = np.asarray(product_ids, dtype=object)
+        rows = np.full(len(product_ids), -1, dtype=np.int64)
+        lo = np.searchsorted(sorted_ids, product_ids, side='left')
+        hi = np.searchsorted(sorted_ids, product_ids, side='right')
+        for i in np.flatnonzero(hi > lo):
+            # A deleted product that came back has a tombstone row next to its live one
+            candidates = order[lo[i]:hi[i]]
+            live = candidates[~np.isin(candidates, self.dead)]
+            if len(live):
+                rows[i] = live[0]
+        return rows
+
+    def updated(self, df_upserts=None, deleted_ids=()):
+        """
+        Snapshot with the products of an encoded products frame upserted (by
+        Product_id) and `deleted_ids` removed. Returns (catalog, changed rows):
+        the sorted rows whose tags or liveness differ from this catalog. Work is
+        proportional to the changed rows, apart from pointer copies of the
+        string columns when products are added.
+        """
+        n_columns = len(self.columns)
+        if df_upserts is not None and len(df_upserts):
+            if set(df_upserts.columns) != set(self.column_order):
+                raise ValueError(f"Upserted products must have the catalog columns; differ in "
+                                 f"{sorted(set(df_upserts.columns) ^ set(self.column_order))}")
+            upsert_ids = df_upserts['Product_id'].fillna('').to_numpy(dtype=object)
+            upsert_tags = tag_matrix(df_upserts[self.columns])
+            upsert_strings = {column: df_upserts[column].fillna('').to_numpy(dtype=object) for column in self.strings}
+        else:
+            upsert_ids = np.empty(0, dtype=object)
+            upsert_tags = np.empty((0, n_columns), dtype=np.uint8)
+            upsert_strings = {column: np.empty(0, dtype=object) for column in self.strings}
+        deleted_ids = np.asarray(list(deleted_ids), dtype=object)
+        if len(set(upsert_ids)) < len(upsert_ids) or len(set(deleted_ids)) < len(deleted_ids):
+            raise ValueError("A Product_id appears more than once in one update")
+        if set(upsert_ids) & set(deleted_ids):
+            raise ValueError(f"Products both upserted and deleted: {sorted(set(upsert_ids) & set(deleted_ids))}")
+
+        deleted_rows = self.rows_of_ids(deleted_ids)
+        if (deleted_rows < 0).any():
+            raise ValueError(f"Cannot delete unknown products {deleted_ids[deleted_rows < 0].tolist()}")
+        upsert_rows = self.rows_of_ids(upsert_ids)
+        added = upsert_rows < 0
+        upsert_rows[added] = self.n_rows + np.arange(added.sum())
+        n_rows = self.n_rows + int(added.sum())
+
+        strings = {}
+        for column, values in self.strings.items():
+            if len(upsert_ids):
+                values = np.concatenate([values, upsert_strings[column][added]])
+                values[upsert_rows] = upsert_strings[column]
+            strings[column] = values
+
+        # Patched rows: every row written since the base matrix with its latest tags; deleted rows lose all tags
+        written = np.concatenate([self.patch_rows, upsert_rows, deleted_rows])
+        values = np.concatenate([self.patch, upsert_tags, np.zeros((len(deleted_rows), n_columns), dtype=np.uint8)])
+        patch_rows, last = np.unique(written[::-1], return_index=True)
+        patch = np.ascontiguousarray(values[::-1][last])
+        dead = np.union1d(self.dead, deleted_rows).astype(np.int64)
+
+        catalog = Catalog(self.column_order, self.columns, self._base, strings, self._next_version(upsert_ids, upsert_tags, deleted_ids),
+                          patch_rows.astype(np.int64), patch, dead)
+        # Carry the Product_id order over: new ids are inserted, rewritten rows keep their place
+        order, sorted_ids = self.id_index()
+        new_rows = upsert_rows[added]
+        new_ids = upsert_ids[added]
+        by_id = np.argsort(new_ids, kind='stable')
+        positions = np.searchsorted(sorted_ids, new_ids[by_id], side='right')
+        catalog._id_index = (np.insert(order, positions, new_rows[by_id]), np.insert(sorted_ids, positions, new_ids[by_id]))
+        changed = np.unique(np.concatenate([upsert_rows, deleted_rows])).astype(np.int64)
+        return catalog, changed
+
+    def _next_version(self, upsert_ids, upsert_tags, deleted_ids):
+        version = self.version if self.version is not None else self.content_version()
+        digest = hashlib.sha256(f"{version}:updated".encode('utf-8'))
+        digest.update('\0'.join(upsert_ids).encode('utf-8'))
+        digest.update(upsert_tags.tobytes())
+        digest.update('\1'.join(deleted_ids).encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+
+def tag_columns(column_order):
+    """The tag columns of a catalog with these columns, in order."""
+    column_order = list(column_order)
+    if "Product_id" not in column_order:
+        raise ValueError("Product catalog has no Product_id column")
+    return [column for column in column_order if column not in TEXT_COLUMNS]
+
+
+def tag_matrix(df_tags, first_row=0):
+    """
+    uint8 matrix of a frame of tag columns. Raises ValueError naming the column
+    and row of the first value that is not 0 or 1 (blank cells included).
+    """
+    try:
+        values = df_tags.to_numpy(dtype=np.float32)
+    except (TypeError, ValueError):
+        for column in df_tags.columns:
+            numeric = pd.to_numeric(df_tags[column], errors='coerce')
+            bad = numeric.isna() & df_tags[column].notna()
+            if bad.any():
+                i = int(np.flatnonzero(bad.to_numpy())[0])
+                raise ValueError(f"Tag column {column!r} holds {df_tags[column].iloc[i]!r} at row {first_row + i}; "
+                                 f"tags must be 0 or 1") from None
+        raise
+    # NaN fails both comparisons, so blank cells are rejected too
+    bad = (values != 0) & (values != 1)
+    if bad.any():
+        i, j = np.argwhere(bad)[0]
+        raise ValueError(f"Tag column {df_tags.columns[j]!r} holds {values[i, j]} at row {first_row + i}; "
+                         f"tags must be 0 or 1")
+    return values.astype(np.uint8)
+
+
+def read_csv_chunks(path, chunk_size=CSV_CHUNK_ROWS):
+    """
+    Yield (uint8 tag matrix, {string column: values}) chunks of an encoded
+    products CSV. Tags are parsed as float32 (the CSV writes them as 1.0/0.0)
+    and validated chunk by chunk, so no float64 frame of the whole catalog is built.
+    """
+    column_order = pd.read_csv(path, nrows=0).columns.tolist()
+    columns = tag_columns(column_order)
+    dtype = {column: np.float32 if column in columns else str for column in column_order}
+    reader = pd.read_csv(path, dtype=dtype, chunksize=chunk_size)
+    start = 0
+    while True:
+        try:
+            chunk = next(reader, None)
+        except ValueError as error:
+            # A tag cell that is not a number fails in the parser, before tag_matrix sees it
+            raise ValueError(f"{path}, rows from {start}: {error}; tags must be 0 or 1") from error
+        if chunk is None:
+            break
+        strings = {column: chunk[column].fillna('').to_numpy(dtype=object)
+                   for column in column_order if column not in columns}
+        yield tag_matrix(chunk[columns], start), strings
+        start += len(chunk)
+
+
+def read_catalog_csv(path, version=None, chunk_size=CSV_CHUNK_ROWS, sparse=False):
+    """
+    Load an encoded products CSV into a Catalog, validating every tag. With
+    `sparse`, each chunk is made sparse as it is read, so the dense matrix
+    never exists in full.
+    """
+    column_order = pd.read_csv(path, nrows=0).columns.tolist()
+    columns = tag_columns(column_order)
+    matrices, strings = [], {column: [] for column in column_order if column not in columns}
+    for matrix, chunk_strings in read_csv_chunks(path, chunk_size):
+        matrices.append(SparseTags.from_dense(matrix) if sparse else matrix)
+        for column, values in chunk_strings.items():
+            strings[column].append(values)
+    if matrices:
+        matrix = SparseTags.stacked(matrices) if sparse else np.asfortranarray(np.concatenate(matrices))
+        strings = {column: np.concatenate(values) for column, values in strings.items()}
+    else:
+        matrix = np.zeros((0, len(columns)), dtype=np.uint8, order='F')
+        matrix = SparseTags.from_dense(matrix) if sparse else matrix
+        strings = {column: np.empty(0, dtype=object) for column in strings}
+    return Catalog(column_order, columns, matrix, strings, version)
+
+
+def file_version(path):
+    """Content hash identifying one catalog source file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def _aligned(offset):
+    return -(-offset // SECTION_ALIGN) * SECTION_ALIGN
+
+
+def _write_sections(path, header, sections):
+    """
+    Lay out `sections` (name, length, write function) after `header` and write
+    the file atomically. Each write function gets the file positioned at its section.
+    """
+    header = dict(header, sections={})
+    # Section offsets depend on the header length, so lay out against a padded header
+    header_bytes = json.dumps(header).encode('utf-8')
+    reserve = len(header_bytes) + 64 * len(sections) + 256
+    offset = _aligned(len(MAGIC) + 8 + reserve)
+    for name, length, _ in sections:
+        header['sections'][name] = [offset, length]
+        offset = _aligned(offset + length)
+    header_bytes = json.dumps(header).encode('utf-8')
+    if len(header_bytes) > reserve:
+        raise ValueError(f"Catalog header of {len(header_bytes)} bytes does not fit in {reserve}")
+    header_bytes = header_bytes.ljust(reserve)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<II', FORMAT_VERSION, len(header_bytes)) + header_bytes)
+        for name, _, write in sections:
+            f.seek(header['sections'][name][0])
+            write(f)
+        f.truncate(offset)
+    os.replace(tmp_path, path)
+
+
+def _catalog_header(column_order, columns, n_rows, version, source):
+    return {
+        'format_version': FORMAT_VERSION,
+        'version': version,
+        'n_rows': n_rows,
+        'column_order': list(column_order),
+        'columns': list(columns),
+        'source': source,
+    }
+
+
+def write_catalog_file(catalog, path, source=None):
+    """Write `catalog` in the binary columnar format (an updated snapshot is written compacted)."""
+    catalog = catalog.compacted()
+
+    def write_matrix(f):
+        # One column at a time, so a sparse catalog is never made dense in full
+        for j in range(len(catalog.columns)):
+            f.write(catalog.features([j])[:, 0].tobytes())
+
+    sections = [('matrix', catalog.n_rows * len(catalog.columns), write_matrix)]
+    for column, values in catalog.strings.items():
+        data = '\0'.join(values).encode('utf-8')
+        sections.append((column, len(data), lambda f, data=data: f.write(data)))
+    header = _catalog_header(catalog.column_order, catalog.columns, catalog.n_rows, catalog.version, source)
+    _write_sections(path, header, sections)
+
+
+def write_catalog_chunks(path, column_order, columns, n_rows, chunks, version=None, source=None):
+    """
+    Write a binary catalog of `n_rows` products from an iterable of
+    (matrix chunk, {text column: values}) pairs without holding the whole
+    catalog in memory. Sections are spooled to temporary files next to `path`.
+    """
+    columns = list(columns)
+    text_columns = [column for column in column_order if column not in columns]
+    spool = {column: f"{path}.{i}.tmp" for i, column in enumerate(['matrix'] + text_columns)}
+    try:
+        # Column-major on disk, so rows are filled in place through a memmap
+        matrix = np.memmap(spool['matrix'], dtype=np.uint8, mode='w+', shape=(max(n_rows, 1), len(columns)), order='F')
+        text_files = {column: open(spool[column], 'wb') for column in text_columns}
+        start = 0
+        try:
+            for matrix_chunk, strings_chunk in chunks:
+                stop = start + len(matrix_chunk)
+                if stop > n_rows:
+                    raise ValueError(f"Chunks hold more than the {n_rows} rows declared")
+                matrix[start:stop] = matrix_chunk
+                for column, f in text_files.items():
+                    if len(strings_chunk[column]):
+                        f.write((b'\0' if start else b'') + '\0'.join(strings_chunk[column]).encode('utf-8'))
+                start = stop
+        finally:
+            for f in text_files.values():
+                f.close()
+            matrix.flush()
+            del matrix
+        if start != n_rows:
+            raise ValueError(f"Chunks hold {start} rows, expected {n_rows}")
+
+        def copy_from(spool_path):
+            def write(f):
+                with open(spool_path, 'rb') as source_file:
+                    shutil.copyfileobj(source_file, f, 1 << 24)
+            return write
+
+        sections = [('matrix', n_rows * len(columns), copy_from(spool['matrix']))]
+        sections += [(column, os.path.getsize(spool[column]), copy_from(spool[column])) for column in text_columns]
+        # The matrix spool may be one padding row long for empty catalogs; copy only what is declared
+        if not n_rows:
+            sections[0] = ('matrix', 0, lambda f: None)
+        _write_sections(path, _catalog_header(column_order, columns, n_rows, version, source), sections)
+    finally:
+        for spool_path in spool.values():
+            if os.path.exists(spool_path):
+                os.remove(spool_path)
+
+
+def read_catalog_header(path):
+    """Return the JSON header of a binary catalog file."""
+    with open(path, 'rb') as f:
+        prefix = f.read(len(MAGIC) + 8)
+        if prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a binary product catalog")
+        format_version, header_length = struct.unpack('<II', prefix[len(MAGIC):])
+        if format_version != FORMAT_VERSION:
+            raise ValueError(f"{path} has catalog format {format_version}, expected {FORMAT_VERSION}")
+        return json.loads(f.read(header_length))
+
+
+def read_catalog_file(path, sparse=False):
+    """
+    Load a binary catalog; the tag matrix is memory-mapped, not read. With
+    `sparse`, the matrix is read once, a column at a time, into SparseTags.
+    """
+    header = read_catalog_header(path)
+    n_rows, columns = header['n_rows'], header['columns']
+    offset, length = header['sections']['matrix']
+    if length:
+        matrix = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(n_rows, len(columns)), order='F')
+    else:
+        matrix = np.zeros((n_rows, len(columns)), dtype=np.uint8, order='F')
+    if sparse:
+        matrix = SparseTags.from_dense(matrix)
+
+    strings = {}
+    with open(path, 'rb') as f:
+        for column in header['column_order']:
+            if column in columns:
+                continue
+            offset, length = header['sections'][column]
+            f.seek(offset)
+            values = f.read(length).decode('utf-8').split('\0') if n_rows else []
+            strings[column] = np.array(values, dtype=object)
+    return Catalog(header['column_order'], columns, matrix, strings, header['version'])
+
+
+def source_stamp(csv_path):
+    """Size and mtime of a source CSV, used to tell whether a built catalog is stale."""
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_catalog(csv_path, out_path=None):
+    """Parse `csv_path` once and write the binary catalog next to it (or to `out_path`)."""
+    out_path = out_path or os.path.splitext(csv_path)[0] + CATALOG_SUFFIX
+    catalog = read_catalog_csv(csv_path, version=file_version(csv_path))
+    write_catalog_file(catalog, out_path, source=source_stamp(csv_path))
+    logger.info(f"Built {out_path}: {catalog.n_rows} products, {len(catalog.columns)} tag columns, version {catalog.version}")
+    return out_path
+
+
+def load_catalog(path, sparse=False):
+    """
+    Load a product catalog from a binary catalog file or an encoded products CSV.
+    A CSV is served from its built binary sibling when that file is up to date.
+    `sparse` keeps the tags as SparseTags instead of a dense matrix.
+    """
+    if path.endswith(CATALOG_SUFFIX):
+        return read_catalog_file(path, sparse)
+
+    built_path = os.path.splitext(path)[0] + CATALOG_SUFFIX
+    if os.path.exists(built_path):
+        if read_catalog_header(built_path)['source'] == source_stamp(path):
+            return read_catalog_file(built_path, sparse)
+        logger.warning(f"{built_path} is older than {path}; parsing the CSV instead")
+    return read_catalog_csv(path, version=file_version(path), sparse=sparse)
+
+
+_catalog_cache = {}
+_catalog_lock = threading.Lock()
+
+
+def _load_stamp(path):
+    """(size, mtime) of `path` and of its built binary sibling, if any."""
+    stamps = [source_stamp(path)]
+    built_path = os.path.splitext(path)[0] + CATALOG_SUFFIX
+    if not path.endswith(CATALOG_SUFFIX) and os.path.exists(built_path):
+        stamps.append(source_stamp(built_path))
+    return stamps
+
+
+def get_catalog(path, sparse=None):
+    """
+    Process-wide shared catalog for `path`, loaded once and reused by every session.
+    The file is only re-read when its size or mtime changes and its content hash differs.
+    Tags are sparse if `sparse` is true, or by default when OVET_SPARSE_CATALOG is set.
+    """
+    path = os.path.abspath(path)
+    sparse = SPARSE_DEFAULT if sparse is None else sparse
+    stamp = _load_stamp(path)
+    with _catalog_lock:
+        cached = _catalog_cache.get((path, sparse))
+        if cached is not None:
+            cached_stamp, catalog = cached
+            if cached_stamp == stamp:
+                return catalog
+            if len(cached_stamp) == len(stamp) and catalog_version(path) == catalog.version:
+                # Touched but unchanged: keep the warm catalog
+                _catalog_cache[(path, sparse)] = (stamp, catalog)
+                return catalog
+
+        catalog = load_catalog(path, sparse)
+        _catalog_cache[(path, sparse)] = (stamp, catalog)
+        logger.info(f"Loaded catalog {path} version {catalog.version} ({catalog.n_rows} products)")
+        return catalog
+
+
+def catalog_version(path):
+    """Version of the catalog stored at `path` without loading it."""
+    if path.endswith(CATALOG_SUFFIX):
+        return read_catalog_header(path)['version']
+    return file_version(path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build the binary product catalog from an encoded products CSV.")
+    parser.add_argument("csv_path", nargs="?", default="encoded_all_products.csv")
+    parser.add_argument("-o", "--output", help=f"output path (default: CSV path with {CATALOG_SUFFIX})")
+    args = parser.parse_args()
+    build_catalog(args.csv_path, args.output)
@@ -0,0 +1,57 @@
+import logging
+import threading
+import time
+
+from compiled_rules import CompiledRules, compiled_rules_for, register_compiled_rules
+
+logger = logging.getLogger(__name__)
+
+# Patched and deleted rows, as a fraction of the catalog, past which an update compacts the catalog
+COMPACT_FRACTION = 0.2
+
+
+class LiveCatalog:
+    """
+    The in-memory catalog a service answers from, updated in place by product
+    upserts and deletes instead of a full reload.
+
+    Every update makes a new Catalog snapshot together with updated rules for
+    each rule table compiled for the current one, registers them with
+    get_compiled_rules and then swaps `catalog` in one assignment. A request
+    that read `catalog` before the swap keeps a consistent snapshot and its
+    rules until it finishes. Updates are serialised by a lock; reads never
+    take it.
+    """
+
+    def __init__(self, catalog, compact_fraction=COMPACT_FRACTION):
+        self.catalog = catalog
+        self.compact_fraction = compact_fraction
+        self._lock = threading.Lock()
+
+    def upsert(self, df_products):
+        """Add or replace (by Product_id) the products of an encoded products frame; returns the new snapshot."""
+        return self.update(df_upserts=df_products)
+
+    def delete(self, product_ids):
+        """Remove products by Product_id; returns the new snapshot."""
+        return self.update(deleted_ids=product_ids)
+
+    def update(self, df_upserts=None, deleted_ids=()):
+        """Apply upserts and deletes as one snapshot; invalid updates raise ValueError and change nothing."""
+        with self._lock:
+            started = time.perf_counter()
+            current = self.catalog
+            catalog, changed = current.updated(df_upserts, deleted_ids)
+            compiled = compiled_rules_for(current)
+            if len(catalog.patch_rows) + len(catalog.dead) > self.compact_fraction * catalog.n_rows:
+                # Patches and tombstones slow every request down; write them into a fresh catalog
+                catalog = catalog.compacted()
+                rules = [CompiledRules(catalog, r.disease_product_mapping) for r in compiled]
+            else:
+                rules = [r.updated(catalog, changed) for r in compiled]
+            for r in rules:
+                register_compiled_rules(catalog, r)
+            self.catalog = catalog
+            logger.info(f"Updated catalog {current.version} -> {catalog.version}: {len(changed)} rows changed, "
+                        f"{len(rules)} rule tables in {time.perf_counter() - started:.3f} s")
+            return catalog
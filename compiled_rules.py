@@ -0,0 +1,448 @@
+import hashlib
+import json
+import logging
+import threading
+import weakref
+
+import numpy as np
+
+from catalog import Catalog
+from ingredients import INGREDIENT_PREFIX, IngredientRegistry
+from tag_index import TagIndex, contains, difference, index_dtype, match_positions, union
+
+logger = logging.getLogger(__name__)
+
+# Tag lists of a disease entry, in the order the recommenders apply them
+RULE_KINDS = ["for", "not_for", "type", "category", "has"]
+# Tag columns that partition the catalog into species shards
+SPECIES_PREFIX = "Species_"
+# Catalog rows whose batch scores a sparse catalog sums at a time (linear_scores_batch)
+SCORE_BLOCK_ROWS = 8192
+
+
+class CompiledRules:
+    """
+    Disease rules compiled once into NumPy arrays over the rows of a product catalog,
+    with the allergy names resolved to its ingredient columns (`ingredients`).
+    Rows deleted from an updated catalog snapshot (`dead`) are in no posting list.
+    """
+
+    def __init__(self, df_products, disease_product_mapping, index=None, product_id_rank=None, diseases=None,
+                 shards=None, ingredients=None):
+        # Accept a loaded Catalog as well as a products DataFrame
+        catalog = df_products if isinstance(df_products, Catalog) else Catalog.from_frame(df_products)
+        self.catalog = catalog
+        self.disease_product_mapping = disease_product_mapping
+        self.n_rows = catalog.n_rows
+        self.product_ids = catalog.product_ids
+        self.dead = catalog.dead
+        self._all_rows = None
+        # Position of each row's Product_id in sorted order, for deterministic tie-breaks
+        # (index and ranks may be passed in prebuilt, e.g. from shared memory)
+        if product_id_rank is None:
+            product_id_rank = np.empty(self.n_rows, dtype=np.int64)
+            product_id_rank[catalog.id_index()[0]] = np.arange(self.n_rows)
+        self.product_id_rank = product_id_rank
+        self.product_id_rank.setflags(write=False)
+        self.columns = catalog.columns
+        self.column_index = {column: j for j, column in enumerate(self.columns)}
+        # Deleted rows carry no tags, so a fresh index leaves them out
+        if index is None:
+            sparse_tags = catalog.sparse_tags()
+            if sparse_tags is not None:
+                # Sparse tags are the posting lists already; index them without a copy
+                index = TagIndex.from_postings(self.n_rows, dict(zip(self.columns, sparse_tags.columns())))
+            else:
+                index = TagIndex(self.matrix, self.columns)
+        self.index = index
+        self.ingredients = ingredients if ingredients is not None else self._ingredient_registry()
+        if diseases is None:
+            diseases = {
+                disease: self._compile_disease(disease_info)
+                for disease, disease_info in disease_product_mapping.items()
+            }
+        self.diseases = diseases
+        self.rules_version = rules_version(disease_product_mapping)
+        self._generation = None
+        # Requests for a species go to its shard, which holds only that species' products
+        if shards is None:
+            shards = {}
+            for column in self.columns:
+                rows = self.postings(column)
+                if column.startswith(SPECIES_PREFIX) and len(rows):
+                    shards[column[len(SPECIES_PREFIX):]] = RulesShard(self, rows, disease_product_mapping)
+        self.shards = shards
+        logger.debug(f"Compiled {len(self.diseases)} diseases over {self.n_rows} products, "
+                     f"shards {dict((species, shard.n_rows) for species, shard in self.shards.items())}")
+
+    @property
+    def matrix(self):
+        """Dense 0/1 feature matrix over every tag column, column-major so one tag column is a contiguous slice."""
+        return self.catalog.matrix
+
+    @property
+    def all_rows(self):
+        """Every row that holds a product, the candidates before any filter."""
+        if self._all_rows is None:
+            rows = self.catalog.live_rows()
+            rows.setflags(write=False)
+            self._all_rows = rows
+        return self._all_rows
+
+    @property
+    def generation(self):
+        """(catalog version, rule table version) that results computed with these rules depend on."""
+        if self._generation is None:
+            catalog_version = self.catalog.version
+            if catalog_version is None:
+                # Catalogs built from a DataFrame carry no file version; hash their content once
+                catalog_version = self.catalog.content_version()
+            self._generation = (catalog_version, self.rules_version)
+        return self._generation
+
+    def postings(self, column):
+        """Sorted rows where `column` is 1, or None if the column is missing."""
+        return self.index.postings(column)
+
+    def _ingredient_registry(self):
+        """Allergy names resolved against the ingredient postings of these rules."""
+        return IngredientRegistry(self.n_rows, {
+            column: self.postings(column) for column in self.columns if column.startswith(INGREDIENT_PREFIX)
+        })
+
+    def species_shard(self, species):
+        """The shard of `species`, or None if no product is tagged for it (and always for a shard)."""
+        return self.shards.get(species)
+
+    def _features(self, active, rows=None):
+        """Tag columns `active` over all rows or only `rows`."""
+        return self.catalog.features(active, rows)
+
+    def linear_scores(self, weights, offset=0, rows=None):
+        """Integer scores `matrix @ weights + offset`, over all rows or only `rows`."""
+        active = np.flatnonzero(weights)
+        n_rows = self.n_rows if rows is None else len(rows)
+        if not len(active):
+            return np.full(n_rows, offset, dtype=np.int64)
+        if self.catalog.sparse:
+            if rows is not None and not (rows[1:] > rows[:-1]).all():
+                # Posting lookups need sorted rows without repeats
+                unique, inverse = np.unique(rows, return_inverse=True)
+                return self.linear_scores(weights, offset, unique)[inverse]
+            # Sparse tags are scored over their posting lists, never densified; deleted rows,
+            # which are in no posting list and never a candidate, score the offset only
+            scores = np.full(n_rows, offset, dtype=np.int64)
+            for j in active:
+                posting = self.postings(self.columns[j])
+                scores[posting if rows is None else match_positions(rows, posting)] += weights[j]
+            return scores
+        # float32 keeps the product on BLAS and is exact for these small integer sums
+        scores = self._features(active, rows).astype(np.float32) @ weights[active].astype(np.float32)
+        return np.rint(scores).astype(np.int64) + offset
+
+    def linear_scores_batch(self, weights, offsets):
+        """Pets x products integer scores `weights @ matrix.T + offsets` for a (pets, columns) weight matrix."""
+        active = np.flatnonzero(weights.any(axis=0))
+        if self.catalog.sparse:
+            # Sparse tags are scored over their posting lists, never densified: each column adds
+            # its weights to the rows it tags, a block of rows at a time so the sums stay in
+            # cache, in int16 when no sum can overflow it
+            bound = np.abs(weights[:, active]).sum(axis=1).max(initial=0)
+            dtype = np.int16 if bound < 2 ** 15 else np.int64
+            postings = [self.postings(self.columns[j]) for j in active]
+            column_weights = weights[:, active].T.astype(dtype)
+            scores = np.empty((len(weights), self.n_rows), dtype=np.int64)
+            block = np.empty((min(SCORE_BLOCK_ROWS, self.n_rows), len(weights)), dtype=dtype)
+            for start in range(0, self.n_rows, SCORE_BLOCK_ROWS):
+                stop = min(start + SCORE_BLOCK_ROWS, self.n_rows)
+                sums = block[:stop - start]
+                sums[:] = 0
+                for posting, w in zip(postings, column_weights):
+                    lo, hi = np.searchsorted(posting, [start, stop])
+                    sums[posting[lo:hi] - start] += w
+                scores[:, start:stop] = sums.T
+        else:
+            scores = np.zeros((len(weights), self.n_rows), dtype=np.int64)
+            if len(active):
+                product = self._features(active).astype(np.float32) @ weights[:, active].T.astype(np.float32)
+                scores += np.rint(product.T).astype(np.int64)
+        return scores + np.asarray(offsets, dtype=np.int64)[:, None]
+
+    def rows_of(self, product_ids):
+        """Row indexes (catalog order) of the given Product_ids; unknown and deleted ids are ignored."""
+        order, sorted_ids = self.catalog.id_index()
+        product_ids = np.array(list(product_ids), dtype=object)
+        lo = np.searchsorted(sorted_ids, product_ids, side='left')
+        hi = np.searchsorted(sorted_ids, product_ids, side='right')
+        rows = np.sort(np.concatenate([order[start:stop] for start, stop in zip(lo, hi)] + [np.empty(0, dtype=np.intp)]))
+        if len(self.dead):
+            rows = difference(rows, self.dead)
+        rows.setflags(write=False)
+        return rows
+
+    def updated(self, catalog, changed):
+        """
+        Rules for `catalog`, a snapshot made by self.catalog.updated() with the
+        sorted `changed` rows. Only the postings of tag columns that changed are
+        rebuilt (the others are shared), only diseases reading those columns or
+        the changed Product_ids are compiled again, and shards are updated the
+        same way. Results equal those of rules compiled from scratch.
+        """
+        all_columns = np.arange(len(self.columns))
+        existing = changed < self.n_rows
+        old = np.zeros((len(changed), len(self.columns)), dtype=np.uint8)
+        old[existing] = self._features(all_columns, changed[existing])
+        new = catalog.features(all_columns, changed)
+        postings = {}
+        for j in np.flatnonzero((old != new).any(axis=0)):
+            column = self.columns[j]
+            postings[column] = updated_posting(self.postings(column), changed, old[:, j], new[:, j])
+        product_id_rank = np.empty(catalog.n_rows, dtype=np.int64)
+        product_id_rank[catalog.id_index()[0]] = np.arange(catalog.n_rows)
+        rules = CompiledRules(catalog, self.disease_product_mapping, index=self.index.updated(catalog.n_rows, postings),
+                              product_id_rank=product_id_rank, diseases=dict(self.diseases), shards={},
+                              ingredients=self.ingredients.updated(catalog.n_rows, postings))
+        changed_ids = set(catalog.product_ids[changed])
+        rules._recompile(postings, changed_ids, changed, old, new)
+
+        for column in self.columns:
+            species = column[len(SPECIES_PREFIX):]
+            if not column.startswith(SPECIES_PREFIX) or not len(rules.postings(column)):
+                continue
+            shard = self.shards.get(species)
+            in_species = new[:, self.column_index[column]] == 1
+            if shard is None or (existing & in_species & ~contains(shard.rows, changed)).any():
+                # A first product of the species, or an existing product that joined it and
+                # so lands inside the shard: build the shard again
+                rules.shards[species] = RulesShard(rules, rules.postings(column), self.disease_product_mapping)
+            else:
+                rules.shards[species] = shard.updated(rules, changed, old, new, in_species, changed_ids)
+        return rules
+
+    def _recompile(self, postings, changed_ids, rows, old, new):
+        """
+        Compile again the diseases that read a column of `postings` or list one
+        of `changed_ids`, given the old and new tags of the changed `rows`.
+        """
+        for disease, disease_info in self.disease_product_mapping.items():
+            reads_tags = any(tag in postings for kind in RULE_KINDS for tag in disease_info.get(kind, []))
+            reads_ids = any(key.startswith('custom_') and not changed_ids.isdisjoint(product_ids)
+                            for key, product_ids in disease_info.items())
+            if reads_tags or reads_ids:
+                # The 'for' union only changes at the changed rows
+                for_union = self.diseases[disease]['for_union']
+                if for_union is not None:
+                    active = [self.column_index[tag] for tag in disease_info['for'] if tag in self.column_index]
+                    for_union = updated_posting(for_union, rows, old[:, active].any(axis=1), new[:, active].any(axis=1))
+                self.diseases[disease] = self._compile_disease(disease_info, for_union)
+
+    def _compile_disease(self, disease_info, for_union=None):
+        """
+        Mirror one disease entry with (tag, posting list) pairs and custom
+        product row indexes; `for_union` may be passed in already built.
+        """
+        compiled = {'missing': {}}
+        for kind in RULE_KINDS:
+            # Postings always list the rows that carry the tag; 'not_for' excludes them
+            compiled[kind] = []
+            for tag in disease_info.get(kind, []):
+                posting = self.postings(tag)
+                if posting is None:
+                    compiled['missing'].setdefault(kind, []).append(tag)
+                else:
+                    compiled[kind].append((tag, posting))
+        # Rows carrying any 'for' tag: the set the v3 'for' union narrows to
+        if for_union is None and compiled['for']:
+            for_union = union([posting for _, posting in compiled['for']])
+        compiled['for_union'] = for_union
+        for key, product_ids in disease_info.items():
+            if key.startswith('custom_'):
+                compiled[key] = self.rows_of(product_ids) if product_ids else None
+        return compiled
+
+
+class RulesShard(CompiledRules):
+    """
+    Compiled rules over the products of one species: the parent's rows where
+    the Species_ column is 1, with their own postings and compiled diseases in
+    shard positions (`rows[position]` is the catalog row). Tag data is not
+    copied, and a product of several species appears in each shard only as a
+    position; scores read the parent matrix through `rows`. Catalog updates
+    leave the positions of products deleted or moved out of the species behind
+    as tombstones (`dead`), so the other positions do not shift.
+    """
+
+    def __init__(self, parent, rows, disease_product_mapping, index=None, diseases=None, dead=None, ingredients=None):
+        self.parent = parent
+        self.rows = rows
+        self.catalog = parent.catalog
+        self.disease_product_mapping = disease_product_mapping
+        self.n_rows = len(rows)
+        self.dead = dead if dead is not None else np.empty(0, dtype=np.int64)
+        self._all_rows = None
+        self._product_ids = None
+        self._product_id_rank = None
+        self.columns = parent.columns
+        self.column_index = parent.column_index
+        if index is None:
+            # A sparse catalog keeps its row positions in the smallest integer type; so do its shards
+            dtype = index_dtype(self.n_rows) if parent.catalog.sparse else np.intp
+            postings = {}
+            for column in self.columns:
+                postings[column] = match_positions(rows, parent.postings(column)).astype(dtype, copy=False)
+                postings[column].setflags(write=False)
+            index = TagIndex.from_postings(self.n_rows, postings)
+        self.index = index
+        self.ingredients = ingredients if ingredients is not None else self._ingredient_registry()
+        if diseases is None:
+            diseases = {
+                disease: self._compile_disease(disease_info)
+                for disease, disease_info in disease_product_mapping.items()
+            }
+        self.diseases = diseases
+        self.rules_version = parent.rules_version
+        self.shards = {}
+
+    @property
+    def generation(self):
+        # Shard results are mapped back to catalog rows, so they belong to the parent's generation
+        return self.parent.generation
+
+    @property
+    def product_ids(self):
+        if self._product_ids is None:
+            product_ids = self.parent.product_ids[self.rows]
+            product_ids.setflags(write=False)
+            self._product_ids = product_ids
+        return self._product_ids
+
+    @property
+    def product_id_rank(self):
+        if self._product_id_rank is None:
+            product_id_rank = np.empty(self.n_rows, dtype=np.int64)
+            product_id_rank[np.argsort(self.parent.product_id_rank[self.rows], kind='stable')] = np.arange(self.n_rows)
+            product_id_rank.setflags(write=False)
+            self._product_id_rank = product_id_rank
+        return self._product_id_rank
+
+    @property
+    def all_rows(self):
+        if self._all_rows is None:
+            rows = difference(np.arange(self.n_rows), self.dead)
+            rows.setflags(write=False)
+            self._all_rows = rows
+        return self._all_rows
+
+    def _features(self, active, rows=None):
+        return self.parent._features(active, self.rows if rows is None else self.rows[rows])
+
+    def positions(self, rows):
+        """Shard positions of catalog `rows`, which must all belong to the shard."""
+        return np.searchsorted(self.rows, rows)
+
+    def rows_of(self, product_ids):
+        rows = match_positions(self.rows, self.parent.rows_of(product_ids))
+        if len(self.dead):
+            rows = difference(rows, self.dead)
+        rows.setflags(write=False)
+        return rows
+
+    def updated(self, parent, changed, old, new, in_species, changed_ids):
+        """
+        This shard under `parent`, the rules CompiledRules.updated made from
+        the old and new tags of the `changed` catalog rows. `in_species` tells
+        which changed rows now hold the species; those past the end of the
+        catalog are appended, the others only change their postings.
+        """
+        rows = np.concatenate([self.rows, changed[(changed >= self.parent.n_rows) & in_species]])
+        rows.setflags(write=False)
+        member = contains(rows, changed)
+        changed, old, new, in_species = changed[member], old[member], new[member], in_species[member]
+        positions = np.searchsorted(rows, changed)
+        # A tombstone position holds no tags, and a row that left the species becomes one
+        old = np.where(contains(self.dead, positions)[:, None], 0, old)
+        new = np.where(in_species[:, None], new, 0)
+        dead = np.union1d(difference(self.dead, positions[in_species]), positions[~in_species]).astype(np.int64)
+        postings = {}
+        for j in np.flatnonzero((old != new).any(axis=0)):
+            column = self.columns[j]
+            postings[column] = updated_posting(self.postings(column), positions, old[:, j], new[:, j])
+        shard = RulesShard(parent, rows, self.disease_product_mapping, index=self.index.updated(len(rows), postings),
+                           diseases=dict(self.diseases), dead=dead,
+                           ingredients=self.ingredients.updated(len(rows), postings))
+        shard._recompile(postings, changed_ids, positions, old, new)
+        return shard
+
+
+def updated_posting(posting, rows, old, new):
+    """`posting` with sorted `rows` whose 0/1 value changed from `old` to `new` moved in or out."""
+    removed = rows[old.astype(bool)]
+    if len(removed):
+        posting = np.delete(posting, np.searchsorted(posting, removed))
+    added = rows[new.astype(bool)]
+    posting = np.insert(posting, np.searchsorted(posting, added), added)
+    posting.setflags(write=False)
+    return posting
+
+
+def rules_version(disease_product_mapping):
+    """Content hash of a disease rule table."""
+    encoded = json.dumps(disease_product_mapping, sort_keys=True, default=list)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:16]
+
+
+# Rules compiled for products DataFrames; rules of a Catalog are kept on the Catalog itself
+_compiled_cache = {}
+_compile_lock = threading.Lock()
+
+
+def _cached_rules(df_products, disease_product_mapping):
+    if isinstance(df_products, Catalog):
+        rules = df_products.compiled_rules.get(id(disease_product_mapping))
+        # The rules hold their table, so a matching id is the same table
+        return rules if rules is not None and rules.disease_product_mapping is disease_product_mapping else None
+    cached = _compiled_cache.get((id(df_products), id(disease_product_mapping)))
+    return cached[1] if cached is not None and cached[0]() is df_products else None
+
+
+def get_compiled_rules(df_products, disease_product_mapping):
+    """Return the rules compiled for this catalog (frame or Catalog), compiling them on first use."""
+    rules = _cached_rules(df_products, disease_product_mapping)
+    if rules is not None:
+        return rules
+
+    # Only the first request for a catalog compiles; later lookups never take the lock
+    with _compile_lock:
+        rules = _cached_rules(df_products, disease_product_mapping)
+        if rules is not None:
+            return rules
+        rules = CompiledRules(df_products, disease_product_mapping)
+        rules.ingredients.report(rules.generation[0])
+        _register(df_products, disease_product_mapping, rules)
+        return rules
+
+
+def _register(df_products, disease_product_mapping, rules):
+    if isinstance(df_products, Catalog):
+        # Rules refer to their Catalog, so a global entry would keep every catalog ever
+        # compiled alive; on the Catalog they are collected with it
+        df_products.compiled_rules[id(disease_product_mapping)] = rules
+        return
+    key = (id(df_products), id(disease_product_mapping))
+    # The rules hold a Catalog built from the frame, not the frame: drop the entry as soon as the frame goes away
+    ref = weakref.ref(df_products, lambda _: _compiled_cache.pop(key, None))
+    _compiled_cache[key] = (ref, rules)
+
+
+def register_compiled_rules(catalog, rules):
+    """Make get_compiled_rules return `rules` for `catalog` and their rule table, e.g. after a catalog update."""
+    with _compile_lock:
+        _register(catalog, rules.disease_product_mapping, rules)
+
+
+def compiled_rules_for(catalog):
+    """Every rules object compiled for `catalog` so far, one per rule table."""
+    with _compile_lock:
+        if isinstance(catalog, Catalog):
+            return list(catalog.compiled_rules.values())
+        return [rules for ref, rules in list(_compiled_cache.values()) if ref() is catalog]
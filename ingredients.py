@@ -0,0 +1,155 @@
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Tag columns that mark the products containing an ingredient
+INGREDIENT_PREFIX = "Ingredients_"
+# Allergies the Streamlit apps offer, lower-cased as they send them ('unknown' never filters)
+ALLERGY_NAMES = [
+    "algae", "barley", "beef", "black beans", "broccoli", "brown rice", "carrot", "chicken", "chickpea", "coconut",
+    "corn", "dairy", "duck", "duck liver", "egg", "fava beans", "fish", "flaxseed", "kangaroo", "lamb", "liver",
+    "milk", "millet", "oat", "pea", "pork", "potato", "pumpkin", "quinoa", "rabbit", "rice", "salmon", "sorghum",
+    "soy", "spinach", "sweet potato", "tapioca", "tomato", "turkey", "venison", "wheat",
+]
+# Other spellings of an ingredient name, by the name of its Ingredients_ column
+ALLERGY_ALIASES = {
+    "black bean": "black beans",
+    "chick pea": "chickpea",
+    "chickpeas": "chickpea",
+    "eggs": "egg",
+    "fava bean": "fava beans",
+    "flax": "flaxseed",
+    "flax seed": "flaxseed",
+    "oats": "oat",
+    "peas": "pea",
+    "potatoes": "potato",
+    "soya": "soy",
+    "sweet potatoes": "sweet potato",
+    "tomatoes": "tomato",
+}
+_SEPARATORS = re.compile(r"[\s_-]+")
+# Bit of each row within its mask byte, in np.packbits order
+_ROW_BITS = (0x80 >> np.arange(8)).astype(np.uint8)
+# (catalog version, unresolved names) already reported, so each catalog is reported once per process
+_reported = set()
+# Unresolved allergy names of requests already logged, least recent first; clients choose
+# these names, so only the last LOGGED_NAMES are remembered
+LOGGED_NAMES = 1024
+_logged = OrderedDict()
+_logged_lock = threading.Lock()
+
+
+def normalize_name(name):
+    """Lower-cased ingredient name with runs of spaces, underscores and hyphens as one space."""
+    return _SEPARATORS.sub(' ', str(name).strip().lower())
+
+
+def _log_unresolved(name):
+    """
+    Log an allergy name a request sent that resolves to nothing, once while it
+    is among the last LOGGED_NAMES. Debug level: report() already warned about
+    the catalog's own gaps, and clients must not be able to flood the log.
+    """
+    with _logged_lock:
+        if name in _logged:
+            _logged.move_to_end(name)
+            return
+        _logged[name] = None
+        if len(_logged) > LOGGED_NAMES:
+            _logged.popitem(last=False)
+    logger.debug(f"Allergy {name!r} matches no ingredient column; it does not filter")
+
+
+def packed_mask(n_rows, posting):
+    """Bitmask over `n_rows` rows with the rows of `posting` set, packed 8 rows a byte."""
+    bits = np.zeros(n_rows, dtype=bool)
+    bits[posting] = True
+    return np.packbits(bits)
+
+
+class IngredientRegistry:
+    """
+    Allergy names resolved once to the Ingredients_ columns of a catalog, with
+    one packed exclusion bitmask over the catalog rows per column. A name
+    resolves through its column (case, spaces, underscores and hyphens do not
+    matter) or through ALLERGY_ALIASES; names that resolve to nothing never
+    filter, as before. Any set of allergies is excluded by ORing their masks
+    in one step.
+    """
+
+    def __init__(self, n_rows, postings, aliases=ALLERGY_ALIASES, masks=None):
+        self.n_rows = n_rows
+        self.columns = [column for column in postings if column.startswith(INGREDIENT_PREFIX)]
+        self._slots = {normalize_name(column[len(INGREDIENT_PREFIX):]): j for j, column in enumerate(self.columns)}
+        for alias, name in aliases.items():
+            slot = self._slots.get(normalize_name(name))
+            if slot is not None:
+                self._slots.setdefault(normalize_name(alias), slot)
+        self.aliases = aliases
+        if masks is None:
+            masks = np.zeros((len(self.columns), -(-n_rows // 8)), dtype=np.uint8)
+            for j, column in enumerate(self.columns):
+                masks[j] = packed_mask(n_rows, postings[column])
+        masks.setflags(write=False)
+        self.masks = masks
+
+    def updated(self, n_rows, postings):
+        """The registry for an updated catalog of `n_rows` rows; only the masks of changed `postings` are rebuilt."""
+        masks = np.zeros((len(self.columns), -(-n_rows // 8)), dtype=np.uint8)
+        masks[:, :self.masks.shape[1]] = self.masks
+        for j, column in enumerate(self.columns):
+            if column in postings:
+                masks[j] = packed_mask(n_rows, postings[column])
+        return IngredientRegistry(n_rows, dict.fromkeys(self.columns), self.aliases, masks)
+
+    def slot(self, name):
+        """Index of the column `name` resolves to, or None."""
+        return self._slots.get(normalize_name(name))
+
+    def resolve(self, name):
+        """Ingredients_ column of an allergy name, or None."""
+        slot = self.slot(name)
+        return None if slot is None else self.columns[slot]
+
+    def slots(self, names):
+        """Column indexes of `names` in order, without repeats; unresolved names are skipped."""
+        slots = []
+        for name in names:
+            slot = self._slots.get(name)
+            if slot is None:
+                slot = self.slot(name)
+            if slot is None:
+                _log_unresolved(name)
+            elif slot not in slots:
+                slots.append(slot)
+        return slots
+
+    def columns_of(self, names):
+        """Ingredients_ columns of `names` in order, without repeats."""
+        return [self.columns[slot] for slot in self.slots(names)]
+
+    def exclude(self, rows, names):
+        """`rows` without the products that contain any ingredient of `names`."""
+        slots = self.slots(names)
+        if not slots:
+            return rows
+        excluded = np.bitwise_or.reduce(self.masks[slots], axis=0)
+        return rows[(excluded[rows >> 3] & _ROW_BITS[rows & 7]) == 0]
+
+    def unresolved(self, names=ALLERGY_NAMES):
+        """Of `names`, those no column or alias resolves."""
+        return [name for name in names if self.slot(name) is None]
+
+    def report(self, catalog_version, names=ALLERGY_NAMES):
+        """Log the allergy names this catalog cannot filter, once per catalog version."""
+        unresolved = self.unresolved(names)
+        key = (catalog_version, tuple(unresolved))
+        if unresolved and key not in _reported:
+            _reported.add(key)
+            logger.warning(f"Catalog {catalog_version}: allergies {unresolved} match no ingredient column "
+                           f"and do not filter; add them to ALLERGY_ALIASES to map them")
@@ -0,0 +1,159 @@
+import contextlib
+import os
+import threading
+import time
+
+import numpy as np
+
+# Stage timing and survivor counts of the recommenders, aggregated per (engine, stage).
+# Off by default; when off, every hook is one flag check. Turn on at runtime with
+# enable() or at start-up with OVET_STAGE_METRICS=1.
+
+# Histogram upper bounds: stage wall time in microseconds, survivors in rows
+TIME_BUCKETS_US = [5, 10, 25, 50, 100, 250, 500, 1_000, 2_500, 5_000, 10_000, 25_000, 50_000, 100_000, 250_000, np.inf]
+ROWS_BUCKETS = [0, 1, 10, 50, 100, 500, 1_000, 5_000, 10_000, 50_000, 100_000, 500_000, 1_000_000, np.inf]
+
+_enabled = os.environ.get("OVET_STAGE_METRICS", "") not in ("", "0")
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {}
+
+
+def enable():
+    """Start recording stage metrics."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stop recording stage metrics; already aggregated metrics are kept."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+class _StageStats:
+    """Histograms of one (engine, stage)."""
+
+    def __init__(self):
+        self.calls = 0
+        self.fallbacks = 0
+        self.time_us_sum = 0.0
+        self.rows_sum = 0
+        self.time_counts = np.zeros(len(TIME_BUCKETS_US), dtype=np.int64)
+        self.rows_counts = np.zeros(len(ROWS_BUCKETS), dtype=np.int64)
+
+    def add(self, time_us, rows, fallbacks):
+        self.calls += 1
+        self.fallbacks += fallbacks
+        self.time_us_sum += time_us
+        self.time_counts[np.searchsorted(TIME_BUCKETS_US, time_us)] += 1
+        if rows is not None:
+            self.rows_sum += rows
+            self.rows_counts[np.searchsorted(ROWS_BUCKETS, rows)] += 1
+
+
+class _Request:
+    """Stage marks of one filter_products call, merged into the totals when it ends."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.started = self.last = time.perf_counter_ns()
+        self.fallbacks = 0
+        self.stages = []
+
+    def mark(self, stage, rows):
+        now = time.perf_counter_ns()
+        self.stages.append((stage, (now - self.last) / 1e3, rows, self.fallbacks))
+        self.last = now
+        self.fallbacks = 0
+
+    def finish(self):
+        # 'total' covers the whole call and ends with the rows of the last stage
+        rows = self.stages[-1][2] if self.stages else None
+        fallbacks = self.fallbacks + sum(stage[3] for stage in self.stages)
+        self.stages.append(('total', (time.perf_counter_ns() - self.started) / 1e3, rows, fallbacks))
+        with _lock:
+            for stage, time_us, stage_rows, stage_fallbacks in self.stages:
+                key = (self.engine, stage)
+                if key not in _stats:
+                    _stats[key] = _StageStats()
+                _stats[key].add(time_us, stage_rows, stage_fallbacks)
+
+
+@contextlib.contextmanager
+def request(engine):
+    """Record the stages marked in this thread until the block ends, as one `engine` request."""
+    if not _enabled:
+        yield
+        return
+    previous = getattr(_local, 'request', None)
+    _local.request = _Request(engine)
+    try:
+        yield
+    finally:
+        recorded, _local.request = _local.request, previous
+        recorded.finish()
+
+
+def mark(stage, rows=None):
+    """Close `stage` of the current request: time since the previous mark and rows left."""
+    if _enabled:
+        recording = getattr(_local, 'request', None)
+        if recording is not None:
+            recording.mark(stage, None if rows is None else len(rows))
+
+
+def fallback():
+    """Note that a filter of the current stage kept its input because it would have left nothing."""
+    if _enabled:
+        recording = getattr(_local, 'request', None)
+        if recording is not None:
+            recording.fallbacks += 1
+
+
+def reset():
+    """Drop every aggregated metric."""
+    with _lock:
+        _stats.clear()
+
+
+def _quantile(counts, bounds, q):
+    """Upper bucket bound below which a fraction `q` of the observations fall."""
+    cumulative = np.cumsum(counts)
+    if not cumulative[-1]:
+        return None
+    return bounds[int(np.searchsorted(cumulative, q * cumulative[-1]))]
+
+
+def snapshot():
+    """Aggregated metrics as {engine: {stage: {...}}} in first-seen stage order."""
+    with _lock:
+        items = list(_stats.items())
+    result = {}
+    for (engine, stage), stats in items:
+        result.setdefault(engine, {})[stage] = {
+            'calls': stats.calls,
+            'fallbacks': stats.fallbacks,
+            'mean_us': stats.time_us_sum / stats.calls,
+            'p50_us': _quantile(stats.time_counts, TIME_BUCKETS_US, 0.5),
+            'p95_us': _quantile(stats.time_counts, TIME_BUCKETS_US, 0.95),
+            'mean_rows': stats.rows_sum / stats.rows_counts.sum() if stats.rows_counts.sum() else None,
+            'time_histogram_us': dict(zip(map(str, TIME_BUCKETS_US), stats.time_counts.tolist())),
+            'rows_histogram': dict(zip(map(str, ROWS_BUCKETS), stats.rows_counts.tolist())),
+        }
+    return result
+
+
+def report():
+    """Text table of the aggregated metrics; p50/p95 are histogram bucket upper bounds."""
+    lines = [f"{'engine':<6} {'stage':<16} {'calls':>7} {'mean us':>9} {'p50<=us':>8} {'p95<=us':>8} {'mean rows':>10} {'fallbacks':>9}"]
+    for engine, stages in snapshot().items():
+        for stage, s in stages.items():
+            mean_rows = '' if s['mean_rows'] is None else f"{s['mean_rows']:.1f}"
+            lines.append(f"{engine:<6} {stage:<16} {s['calls']:>7} {s['mean_us']:>9.1f} {s['p50_us']:>8} "
+                         f"{s['p95_us']:>8} {mean_rows:>10} {s['fallbacks']:>9}")
+    return "\n".join(lines)
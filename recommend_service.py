@@ -0,0 +1,299 @@
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from catalog import get_catalog
+from compiled_rules import get_compiled_rules
+from recommendation_table import engine_module
+
+logger = logging.getLogger(__name__)
+
+# pet_info fields the V5 recommender reads, as streamlit_Scored.py builds them
+PET_FIELDS = ['species', 'life_stage', 'activity level', 'main_issue', 'other_issues', 'other_issues_list',
+              'breed_size', 'body score (bds)', 'pregnant', 'lactating', 'allergy', 'allergic_to']
+# Fields the recommender treats as text, and as numbers (weight and age are optional)
+TEXT_FIELDS = ['species', 'life_stage', 'breed_size', 'activity level', 'main_issue']
+NUMBER_FIELDS = ['weight', 'age (months)', 'body score (bds)']
+# Latency samples kept for the metrics percentiles
+METRICS_WINDOW = 10_000
+
+
+class ServiceMetrics:
+    """Request latency, queue wait, batch size and queue depth over the last METRICS_WINDOW samples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self._latency_ms = deque(maxlen=METRICS_WINDOW)
+        self._wait_ms = deque(maxlen=METRICS_WINDOW)
+        self._batch_ms = deque(maxlen=METRICS_WINDOW)
+        self._batch_sizes = deque(maxlen=METRICS_WINDOW)
+
+    def add_batch(self, size, waits_ms, batch_ms, queue_depth):
+        with self._lock:
+            self.batches += 1
+            self._batch_sizes.append(size)
+            self._wait_ms.extend(waits_ms)
+            self._batch_ms.append(batch_ms)
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def add_request(self, latency_ms, error=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += error
+            self._latency_ms.append(latency_ms)
+
+    def snapshot(self, queue_depth):
+        """Counters and p50/p95/p99 of every sample window, in milliseconds."""
+        with self._lock:
+            windows = {'latency_ms': list(self._latency_ms), 'queue_wait_ms': list(self._wait_ms),
+                       'batch_ms': list(self._batch_ms), 'batch_size': list(self._batch_sizes)}
+            result = {
+                'uptime_s': round(time.time() - self.started, 1),
+                'requests': self.requests,
+                'errors': self.errors,
+                'batches': self.batches,
+                'queue_depth': queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+            }
+        for name, values in windows.items():
+            if values:
+                p50, p95, p99 = np.percentile(values, [50, 95, 99])
+                result[name] = {'mean': round(float(np.mean(values)), 3), 'p50': round(float(p50), 3),
+                                'p95': round(float(p95), 3), 'p99': round(float(p99), 3),
+                                'max': round(float(max(values)), 3)}
+            else:
+                result[name] = None
+        return result
+
+
+class MicroBatcher:
+    """
+    Collects pets submitted by concurrent requests and scores them together:
+    a batch closes when it holds `max_batch` pets or `window_ms` after its
+    first pet arrived, and is scored in one recommend_records call (one per
+    distinct top_k). A single thread scores, so batches never compete for
+    the CPU with each other.
+    """
+
+    def __init__(self, catalog_path='encoded_all_products.csv', max_batch=64, window_ms=2.0):
+        self.catalog_path = catalog_path
+        self.max_batch = max_batch
+        self.window_ms = window_ms
+        self.module = engine_module('v5')
+        self.metrics = ServiceMetrics()
+        self._queue = queue.Queue()
+        # Load and compile once, so the first request does not pay for it
+        self.rules()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def rules(self):
+        """Rules of the current catalog; a changed catalog file is reloaded and compiled once."""
+        return get_compiled_rules(get_catalog(self.catalog_path), self.module.disease_product_mapping)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, pet, top_k=None):
+        """Future of (ranked (Product_id, Score) list, number of products that passed) for one pet."""
+        future = Future()
+        self._queue.put((pet, top_k, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.window_ms / 1e3
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Score what was collected, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            waits_ms = [(started - enqueued) * 1e3 for _, _, _, enqueued in batch]
+            try:
+                self._score(batch)
+            except Exception as error:
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            self.metrics.add_batch(len(batch), waits_ms, (time.perf_counter() - started) * 1e3, self.queue_depth())
+
+    def _score(self, batch):
+        rules = self.rules()
+        # Bound the pets x products score matrix whatever the catalog size
+        size = self.module.score_batch_size(rules)
+        by_top_k = {}
+        for item in batch:
+            by_top_k.setdefault(item[1], []).append(item)
+        for top_k, items in by_top_k.items():
+            for start in range(0, len(items), size):
+                chunk = items[start:start + size]
+                try:
+                    results = self.module.recommend_records([pet for pet, _, _, _ in chunk], rules, top_k)
+                except Exception:
+                    # One malformed pet fails the whole call; score one by one so only its request fails
+                    results = []
+                    for pet, _, future, _ in chunk:
+                        try:
+                            results.append(self.module.recommend_records([pet], rules, top_k)[0])
+                        except Exception as error:
+                            future.set_exception(error)
+                            results.append(None)
+                for (_, _, future, _), result in zip(chunk, results):
+                    if result is not None:
+                        future.set_result(result)
+
+
+def validate_pet(pet):
+    """Error message for a request body that is not a usable pet_info object, else None."""
+    if not isinstance(pet, dict):
+        return "Request body must be a JSON object with the pet_info fields"
+    missing = [field for field in PET_FIELDS if field not in pet]
+    if missing:
+        return f"Missing pet fields {missing}"
+    for field in TEXT_FIELDS:
+        if not isinstance(pet[field], str):
+            return f"{field!r} must be a string"
+    for field in NUMBER_FIELDS:
+        value = pet.get(field)
+        if field in PET_FIELDS or value is not None:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return f"{field!r} must be a number"
+    for field in ('other_issues_list', 'allergic_to'):
+        if not isinstance(pet[field], list) or not all(isinstance(item, str) for item in pet[field]):
+            return f"{field!r} must be a list of strings"
+    return None
+
+
+class RecommendationHandler(BaseHTTPRequestHandler):
+    """POST /recommend[?top_k=N] with a pet_info JSON object; GET /metrics and /health."""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        batcher = self.server.batcher
+        if path == '/health':
+            self._send(200, {'status': 'ok', 'catalog_version': batcher.rules().generation[0]})
+        elif path == '/metrics':
+            self._send(200, batcher.metrics.snapshot(batcher.queue_depth()))
+        else:
+            self._send(404, {'error': f"Unknown path {path}"})
+
+    def do_POST(self):
+        started = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != '/recommend':
+            self._send(404, {'error': f"Unknown path {url.path}"})
+            return
+        batcher = self.server.batcher
+        try:
+            top_k = parse_qs(url.query).get('top_k')
+            top_k = int(top_k[0]) if top_k else None
+            length = int(self.headers.get('Content-Length', 0))
+            pet = json.loads(self.rfile.read(length) or b'null')
+        except ValueError as error:
+            self._send(400, {'error': f"Bad request: {error}"})
+            batcher.metrics.add_request((time.perf_counter() - started) * 1e3, error=True)
+            return
+        problem = validate_pet(pet)
+        if problem is not None:
+            self._send(400, {'error': problem})
+            batcher.metrics.add_request((time.perf_counter() - started) * 1e3, error=True)
+            return
+        try:
+            products, count = batcher.submit(pet, top_k).result()
+        except (KeyError, TypeError, ValueError) as error:
+            self._send(400, {'error': f"Cannot score pet: {error!r}"})
+            batcher.metrics.add_request((time.perf_counter() - started) * 1e3, error=True)
+            return
+        except Exception as error:
+            logger.exception(f"Scoring failed: {error}")
+            self._send(500, {'error': "Scoring failed"})
+            batcher.metrics.add_request((time.perf_counter() - started) * 1e3, error=True)
+            return
+        latency_ms = (time.perf_counter() - started) * 1e3
+        self._send(200, {
+            'products': [{'Product_id': product_id, 'Score': score} for product_id, score in products],
+            'count': count,
+            'latency_ms': round(latency_ms, 3),
+        })
+        batcher.metrics.add_request(latency_ms)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class RecommendationServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bursts of concurrent clients are the point of batching; the default backlog of 5 resets them
+    request_queue_size = 1024
+
+
+def make_server(host='127.0.0.1', port=8000, catalog_path='encoded_all_products.csv', max_batch=64, window_ms=2.0):
+    """HTTP server answering from a warm MicroBatcher; call serve_forever() on it."""
+    server = RecommendationServer((host, port), RecommendationHandler)
+    server.batcher = MicroBatcher(catalog_path, max_batch, window_ms)
+    return server
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description="Serve V5 recommendations over HTTP with request micro-batching.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--catalog", default="encoded_all_products.csv")
+    parser.add_argument("--max-batch", type=int, default=64, help="pets scored together at most")
+    parser.add_argument("--window-ms", type=float, default=2.0, help="how long a batch waits for more requests")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port, args.catalog, args.max_batch, args.window_ms)
+    logger.info(f"Serving recommendations on http://{args.host}:{server.server_address[1]}/recommend")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
@@ -0,0 +1,247 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from catalog import get_catalog
+from compiled_rules import get_compiled_rules
+
+logger = logging.getLogger(__name__)
+
+# Values every recommender distinguishes; species and breed sizes come from the catalog
+LIFE_STAGES = ['growth', 'adult', 'senior']
+# One body score per band (under, normal, over)
+BODY_SCORES = [2, 5, 8]
+# v3 only reacts to 'Active', V5 only to 'active'; the engine's table_key merges the rest
+ACTIVITY_LEVELS = ['Active', 'active', 'not active']
+# (pregnant, lactating)
+REPRODUCTIVE_STATES = [(False, False), (True, False), (False, True), (True, True)]
+NO_MAIN_ISSUE = '-- select main issue --'
+
+
+def engine_module(engine):
+    """The recommender module of `engine` ('v3' or 'v5')."""
+    if engine == 'v3':
+        import rule_based_v3_streamlit as module
+    elif engine == 'v5':
+        from V5 import rule_based_v5_scored as module
+    else:
+        raise ValueError(f"Unknown engine {engine!r}")
+    return module
+
+
+def common_profiles(rules):
+    """
+    One pet for every combination of the inputs a recommender reads apart from
+    allergies and other issues: species, main issue, life stage, breed size,
+    body score band, activity and pregnancy/lactation.
+    """
+    species = [column[len('Species_'):] for column in rules.columns if column.startswith('Species_')]
+    breed_sizes = [column[len('breed_size_'):] for column in rules.columns if column.startswith('breed_size_')]
+    main_issues = list(rules.diseases) + [NO_MAIN_ISSUE]
+    for values in itertools.product(species, main_issues, LIFE_STAGES, breed_sizes, BODY_SCORES,
+                                    ACTIVITY_LEVELS, REPRODUCTIVE_STATES):
+        pet_species, main_issue, life_stage, breed_size, bds, activity, (pregnant, lactating) = values
+        yield {
+            'species': pet_species,
+            'main_issue': main_issue,
+            'life_stage': life_stage,
+            'breed_size': breed_size,
+            'body score (bds)': bds,
+            'activity level': activity,
+            'pregnant': pregnant,
+            'lactating': lactating,
+            'allergy': 0,
+            'allergic_to': [],
+            'other_issues': 0,
+            'other_issues_list': [],
+        }
+
+
+class RecommendationTable:
+    """
+    Precomputed recommender results for a finite profile space.
+
+    Each section ('full', and 'prefix' for v3) maps canonical profile keys to
+    a set of arrays (row positions, and scores for V5); the arrays of every
+    key are stored back to back with one offsets array per section.
+    """
+
+    def __init__(self, engine, generation, sections, coverage):
+        self.engine = engine
+        self.generation = tuple(generation)
+        self.sections = sections
+        self.coverage = coverage
+        self._index = {name: {key: i for i, key in enumerate(section['keys'])} for name, section in sections.items()}
+        self._lookups = Counter()
+        self._lock = threading.Lock()
+
+    def serves(self, rules):
+        """True if the table was built for this catalog and rule table; counted when it was not."""
+        if rules.generation == self.generation:
+            return True
+        self._count('stale')
+        return False
+
+    def get(self, name, key):
+        """Arrays stored for `key` in section `name`, or None."""
+        i = self._index.get(name, {}).get(key)
+        self._count(f"{name}_hit" if i is not None else f"{name}_miss")
+        if i is None:
+            return None
+        section = self.sections[name]
+        start, stop = section['offsets'][i], section['offsets'][i + 1]
+        return {array: values[start:stop] for array, values in section['arrays'].items()}
+
+    def _count(self, outcome):
+        with self._lock:
+            self._lookups[outcome] += 1
+
+    def lookups(self):
+        """Online lookups so far, by outcome."""
+        with self._lock:
+            return dict(self._lookups)
+
+    def save(self, path):
+        """Write the table as a single compressed .npz file."""
+        meta = {
+            'engine': self.engine,
+            'generation': list(self.generation),
+            'coverage': self.coverage,
+            'sections': {name: [list(key) for key in section['keys']] for name, section in self.sections.items()},
+        }
+        arrays = {'meta': np.array(json.dumps(meta))}
+        for name, section in self.sections.items():
+            arrays[f"{name}.offsets"] = section['offsets']
+            for array, values in section['arrays'].items():
+                arrays[f"{name}.{array}"] = values
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    def coverage_report(self):
+        """Text summary of what was precomputed and how online lookups were served."""
+        c = self.coverage
+        lines = [
+            f"engine {self.engine}, catalog version {self.generation[0]}, rules version {self.generation[1]}",
+            f"catalog rows {c['n_rows']}, built in {c['build_seconds']:.1f} s",
+            f"profiles enumerated {c['profiles']}: " + ", ".join(f"{len(v)} {k}" for k, v in c['dimensions'].items()),
+            "not precomputed: allergies and other issues (served as residual stages or computed online)",
+        ]
+        for name, section in c['sections'].items():
+            lines.append(f"section {name}: {section['entries']} entries, {section['stored_rows']} stored rows "
+                         f"(mean {section['mean_rows']:.1f}, max {section['max_rows']}), {section['bytes'] / 1e6:.2f} MB")
+        lookups = self.lookups()
+        if lookups:
+            lines.append("online lookups: " + ", ".join(f"{k} {v}" for k, v in sorted(lookups.items())))
+        return "\n".join(lines)
+
+
+def load_table(path):
+    """Load a table written by RecommendationTable.save."""
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data['meta']))
+        sections = {}
+        for name, keys in meta['sections'].items():
+            prefix = f"{name}."
+            arrays = {k[len(prefix):]: data[k] for k in data.files if k.startswith(prefix) and k != f"{name}.offsets"}
+            for values in arrays.values():
+                values.setflags(write=False)
+            sections[name] = {'keys': [tuple(key) for key in keys], 'offsets': data[f"{name}.offsets"], 'arrays': arrays}
+    return RecommendationTable(meta['engine'], meta['generation'], sections, meta['coverage'])
+
+
+_table_cache = {}
+_table_lock = threading.Lock()
+
+
+def get_table(path):
+    """Process-wide shared table for `path`, reloaded when the file changes; None if it was never built."""
+    path = os.path.abspath(path)
+    try:
+        stamp = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _table_lock:
+        cached = _table_cache.get(path)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, load_table(path))
+            _table_cache[path] = cached
+        return cached[1]
+
+
+def _pack(entries, n_rows):
+    """Concatenate per-key arrays with the smallest dtype that holds them."""
+    keys = list(entries)
+    lengths = [len(entries[key]['rows']) for key in keys]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    arrays = {}
+    for array in (entries[keys[0]] if keys else {'rows': None}):
+        values = np.concatenate([entries[key][array] for key in keys]) if keys else np.empty(0, dtype=np.int32)
+        if array == 'rows':
+            dtype = np.int32 if n_rows < 2 ** 31 else np.int64
+        else:
+            dtype = np.int16 if not len(values) or np.abs(values).max() < 2 ** 15 else np.int32
+        arrays[array] = values.astype(dtype)
+    return {'keys': keys, 'offsets': offsets, 'arrays': arrays}
+
+
+def build_table(engine, df_products):
+    """Precompute `engine` results for every common profile over a catalog (frame or Catalog)."""
+    module = engine_module(engine)
+    rules = get_compiled_rules(df_products, module.disease_product_mapping)
+    started = time.perf_counter()
+    entries = {'full': {}}
+    if hasattr(module, 'materialize_prefix'):
+        entries['prefix'] = {}
+    dimensions = {}
+    profiles = 0
+    for pet in common_profiles(rules):
+        profiles += 1
+        for field in ('species', 'main_issue', 'life_stage', 'breed_size', 'body score (bds)', 'activity level'):
+            dimensions.setdefault(field, set()).add(pet[field])
+        key = module.table_key(pet, rules.diseases)
+        if key not in entries['full']:
+            entries['full'][key] = module.materialize(pet, rules)
+        if 'prefix' in entries:
+            key = module.prefix_key(pet, rules.diseases)
+            if key not in entries['prefix']:
+                entries['prefix'][key] = module.materialize_prefix(pet, rules)
+
+    sections = {name: _pack(section, rules.n_rows) for name, section in entries.items()}
+    coverage = {
+        'n_rows': rules.n_rows,
+        'profiles': profiles,
+        'build_seconds': time.perf_counter() - started,
+        'dimensions': {field: sorted(map(str, values)) for field, values in dimensions.items()},
+        'sections': {},
+    }
+    for name, section in sections.items():
+        lengths = np.diff(section['offsets'])
+        coverage['sections'][name] = {
+            'entries': len(section['keys']),
+            'stored_rows': int(lengths.sum()),
+            'mean_rows': float(lengths.mean()) if len(lengths) else 0.0,
+            'max_rows': int(lengths.max()) if len(lengths) else 0,
+            'bytes': int(section['offsets'].nbytes + sum(values.nbytes for values in section['arrays'].values())),
+        }
+    logger.info(f"Materialized {engine} results for {profiles} profiles in {coverage['build_seconds']:.1f} s")
+    return RecommendationTable(engine, rules.generation, sections, coverage)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Precompute recommendations for every common pet profile.")
+    parser.add_argument("--engine", choices=["v3", "v5"], default="v3")
+    parser.add_argument("--catalog", default="encoded_all_products.csv")
+    parser.add_argument("-o", "--output", help="output .npz path (default: recommendations_<engine>.npz)")
+    args = parser.parse_args()
+    table = build_table(args.engine, get_catalog(args.catalog))
+    table.save(args.output or f"recommendations_{args.engine}.npz")
+    print(table.coverage_report())
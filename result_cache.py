@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of recommendation results with an optional time-to-live.
+
+    Every lookup carries the generation (catalog version, rule table version)
+    of the rules in use; when it differs from the generation the entries were
+    computed with, the cache empties itself before answering.
+    """
+
+    def __init__(self, maxsize=4096, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._generation = generation
+
+    def get(self, key, generation, default=None):
+        """Cached value for `key`, or `default` if absent, expired or of another generation."""
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, generation, value):
+        """Store `value` for `key`, evicting the least recently used entries beyond maxsize."""
+        if self.maxsize <= 0:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._check_generation(generation)
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Counters and current size."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def unique_in_order(values):
+    """`values` without repeats, first occurrences in their original order."""
+    return tuple(dict.fromkeys(values))
+
+
+def body_score_band(bds):
+    """The body score bands both recommenders distinguish."""
+    return 'over' if bds >= 7 else 'under' if bds <= 3 else 'normal'
@@ -2,6 +2,11 @@ import pandas as pd
 import numpy as np
 import logging
 
+import instrumentation
+from compiled_rules import get_compiled_rules
+from result_cache import ResultCache, body_score_band, unique_in_order
+from tag_index import contains, difference, intersect, match_positions
+
 disease_product_mapping = {
     # ===== METABOLIC/ENDOCRINE =====
     "diabetes": {
@@ -464,185 +469,425 @@ disease_product_mapping = {
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# The hard filters work on an integer array of row positions that each stage
+# narrows against sorted posting lists (the rows carrying a tag); rows are only
+# projected into a DataFrame (or Product_ids) at the end.
+
+# Candidate sets smaller than this run filter chains in order instead of planned
+PLAN_MIN_ROWS = 2048
+
+# Results of recent pet profiles, shared by every caller of filter_products
+profile_cache = ResultCache(maxsize=4096, ttl=3600)
+
+def frame_posting(df, column, value=1):
+    """Sorted positions of `df` rows where `column` == `value`, or None if the column is missing."""
+    if column not in df.columns:
+        return None
+    return np.flatnonzero((df[column] == value).to_numpy())
+
+def frame_tag_postings(df, disease_info, kind, value=1):
+    """(tag, posting) pairs of one disease entry kind for the columns `df` has."""
+    postings = [(tag, frame_posting(df, tag, value)) for tag in disease_info.get(kind, [])]
+    return [(tag, posting) for tag, posting in postings if posting is not None]
+
+def project_rows(df, rows):
+    """Materialize `rows` of `df` once; `df` itself comes back when nothing was dropped or reordered."""
+    if len(rows) == len(df) and (rows == np.arange(len(df))).all():
+        return df
+    return df.iloc[rows]
+
+def narrow_rows(rows, posting):
+    """Keep `rows` found in `posting`, unless that would leave nothing (the filter_by_condition fallback)."""
+    if posting is None:
+        return rows
+    kept = intersect(rows, posting)
+    if len(kept):
+        return kept
+    instrumentation.fallback()
+    return rows
+
+def exclude_rows(rows, posting):
+    """Drop `rows` found in `posting`, unless that would leave nothing."""
+    if posting is None:
+        return rows
+    kept = difference(rows, posting)
+    if len(kept):
+        return kept
+    instrumentation.fallback()
+    return rows
+
+def union_for_rows(rows, for_postings):
+    """Union of `rows` matching each 'for' (tag, posting), in tag order and without duplicates."""
+    matched = []
+    for tag, posting in for_postings:
+        tag_rows = intersect(rows, posting)
+        if len(tag_rows):
+            matched.append(tag_rows)
+            logger.debug(f"Filtered by '{tag}': {len(tag_rows)} rows found")
+    if not matched:
+        if for_postings:
+            instrumentation.fallback()
+        return rows  # No matches for any tag
+    if len(matched) == 1:
+        return matched[0]
+    combined = np.concatenate(matched)
+    # Keep the first occurrence of each row, like concat(...).drop_duplicates()
+    _, first = np.unique(combined, return_index=True)
+    combined = combined[np.sort(first)]
+    logger.debug(f"Combined 'for' tags: {len(combined)} rows total")
+    return combined
+
+def narrow_tag_rows(rows, tag_postings, exclude=False):
+    """Apply (tag, posting) filters one after another, each with the empty-result fallback."""
+    for _, posting in tag_postings:
+        rows = exclude_rows(rows, posting) if exclude else narrow_rows(rows, posting)
+    return rows
+
+def life_stage_rows(rows, postings, life_stage):
+    """Filter rows by life stage (growth/adult/senior); `postings(column)` gives a column's posting list."""
+    if life_stage in ['growth', 'adult', 'senior']:
+        life_stage_filter = (
+            contains(postings(f'life_stage_{life_stage}'), rows) |
+            contains(postings('life_stage_all'), rows) |
+            ((life_stage == 'senior') & (len(rows) < 10) & contains(postings('life_stage_adult'), rows))
+        )
+        if life_stage_filter.any():
+            rows = rows[life_stage_filter]
+        else:
+            instrumentation.fallback()
+    return rows
+
 def filter_by_condition(df, column, value):
     """Filter DataFrame where `column` == `value` if column exists and has valid values."""
-    if column in df.columns and df[column].any():
-        filtered = df[df[column] == value]
-        if not filtered.empty:
-            #print(filtered[column].value_counts())
-            logger.debug(f"Filtered by '{column}={value}': {len(filtered)} rows remaining")
-            return filtered
-    #print("empty")
-    return df
+    return project_rows(df, narrow_rows(np.arange(len(df)), frame_posting(df, column, value)))
 
 def filter_for_tags(df, disease_info):
-    """Combine (union) DataFrames filtered by each 'for' tag individually."""
-    if 'for' not in disease_info or not disease_info['for']:
-        return df
-    
-    filtered_dfs = []
-    for tag in disease_info['for']:
-        if tag in df.columns:
-            temp_df = df[df[tag] == 1]
-            if not temp_df.empty:
-                filtered_dfs.append(temp_df)
-                logger.debug(f"Filtered by '{tag}': {len(temp_df)} rows found")
-    
-    if filtered_dfs:
-        combined_df = pd.concat(filtered_dfs).drop_duplicates()
-        logger.debug(f"Combined 'for' tags: {len(combined_df)} rows total")
-        return combined_df
-    return df  # No matches for any tag
+    """Combine (union) the rows matching each 'for' tag individually."""
+    return project_rows(df, union_for_rows(np.arange(len(df)), frame_tag_postings(df, disease_info, 'for')))
 
 def filter_not_for_tags(df, disease_info):
     """Apply 'not_for' tag filters from disease_info."""
-    if 'not_for' in disease_info:
-        for tag in disease_info['not_for']:
-            df = filter_by_condition(df, tag, 0)
-    return df
+    return project_rows(df, narrow_tag_rows(np.arange(len(df)), frame_tag_postings(df, disease_info, 'not_for', 0)))
+
 def filter_type_tags(df, disease_info):
     """Apply 'type' tag filters from disease_info."""
-    if 'type' in disease_info:
-        for tag in disease_info['type']:
-            df = filter_by_condition(df, tag, 1)
-    return df
+    return project_rows(df, narrow_tag_rows(np.arange(len(df)), frame_tag_postings(df, disease_info, 'type')))
 
 def filter_category_tags(df, disease_info):
     """Optional: Apply 'category' tag filters from disease_info."""
-    if 'category' in disease_info:
-        for tag in disease_info['category']:
-            df = filter_by_condition(df, tag, 1)
-    return df
+    return project_rows(df, narrow_tag_rows(np.arange(len(df)), frame_tag_postings(df, disease_info, 'category')))
 
 def filter_has_tags(df, disease_info):
     """Optional: Apply 'has' tag filters from disease_info."""
-    if 'has' in disease_info:
-        for tag in disease_info['has']:
-            df = filter_by_condition(df, tag, 1)
-    return df
+    return project_rows(df, narrow_tag_rows(np.arange(len(df)), frame_tag_postings(df, disease_info, 'has')))
 
 def filter_life_stage(df, life_stage):
     """Filter by life stage (growth/adult/senior)."""
-    if life_stage in ['growth', 'adult', 'senior']:
-        life_stage_filter = (
-            (df[f'life_stage_{life_stage}'] == 1) |
-            (df['life_stage_all'] == 1) |
-            ((life_stage == 'senior') & (len(df) < 10) & (df['life_stage_adult'] == 1))
-        )
-        if life_stage_filter.any():
-            df = df[life_stage_filter]
-    return df
+    return project_rows(df, life_stage_rows(np.arange(len(df)), lambda column: frame_posting(df, column), life_stage))
+
+def plan_filters(filters, n_rows):
+    """
+    Drop (posting, exclude) filters that can never change a row set (missing
+    column, tag on no row or on every row) and order the rest from most to
+    least selective. Posting lengths are the precomputed column cardinalities.
+    """
+    filters = [(posting, exclude) for posting, exclude in filters if posting is not None and 0 < len(posting) < n_rows]
+    # Fraction of the catalog a filter keeps; the stable sort leaves ties in chain order
+    return filters, sorted(filters, key=lambda f: n_rows - len(f[0]) if f[1] else len(f[0]))
+
+def select_positions(values, posting, exclude):
+    """Positions of sorted `values` in `posting` (or not in it, with `exclude`)."""
+    matched = match_positions(values, posting)
+    if not exclude:
+        return matched
+    kept = np.ones(len(values), dtype=bool)
+    kept[matched] = False
+    return np.flatnonzero(kept)
+
+def chain_positions(values, filters, fallback):
+    """
+    Positions of sorted `values` left by a filter chain. With `fallback`, a
+    filter that would leave nothing is skipped (narrow_rows/exclude_rows);
+    without it, None is returned as soon as nothing is left.
+    """
+    kept = np.arange(len(values))
+    for posting, exclude in filters:
+        # A set of one row is left unchanged by every filter (kept or fallen back)
+        if fallback and len(kept) <= 1:
+            break
+        step = select_positions(values, posting, exclude)
+        if not len(step):
+            if not fallback:
+                return None
+            instrumentation.fallback()
+            continue
+        kept = kept[step]
+        values = values[step]
+    return kept
+
+def run_filters(rows, filters, n_rows):
+    """
+    Apply a chain of narrow_rows/exclude_rows filters with their exact fallback semantics.
 
-def filter_products(df_pet_info, df_products):
-    """Main filtering logic for pet products."""
-    species_col = f"Species_{df_pet_info.iloc[0]['species']}"
-    # species_col = f"Species_{df_pet_info['species']}"
-    df_filtered = filter_by_condition(df_products, species_col, 1)
+    The chain first runs most selective first without fallback. If rows
+    survive, that equals the chain in its original order: every intermediate
+    set there contains the final one, so no filter fell back. If the reordered
+    pass leaves nothing, some filter falls back and the original order is
+    replayed. Both passes work on the sorted candidates so each step costs the
+    smaller of the candidate set and the posting list; `rows` order is restored
+    at the end, since filters only ever drop rows.
+    """
+    if len(rows) < PLAN_MIN_ROWS:
+        # Planning costs more than it saves on small candidate sets
+        for posting, exclude in filters:
+            if len(rows) <= 1:
+                break
+            rows = exclude_rows(rows, posting) if exclude else narrow_rows(rows, posting)
+        return rows
+    filters, planned = plan_filters(filters, n_rows)
+    if not filters:
+        return rows
+    order = None if (rows[1:] > rows[:-1]).all() else np.argsort(rows)
+    values = rows if order is None else rows[order]
+    kept = chain_positions(values, planned, fallback=False)
+    if kept is None:
+        kept = chain_positions(values, filters, fallback=True)
+    return rows[kept] if order is None else rows[np.sort(order[kept])]
 
-    # Store original product IDs before filtering for main issue
-    original_product_ids = set(df_filtered['Product_id'].tolist())
+def run_stages(rows, stages, n_rows, mark_last=True):
+    """
+    Apply consecutive filter stages, a list of (stage, filters), as one planned
+    run_filters chain, marking each stage (the last one only with `mark_last`).
+    A chain gives the same rows when split at stage boundaries, so while stage
+    metrics are recorded each stage runs on its own and is marked with its
+    exact survivors and fallbacks.
+    """
+    if not instrumentation.is_enabled():
+        return run_filters(rows, [f for _, filters in stages for f in filters], n_rows)
+    for i, (stage, filters) in enumerate(stages):
+        rows = run_filters(rows, filters, n_rows)
+        if mark_last or i < len(stages) - 1:
+            instrumentation.mark(stage, rows)
+    return rows
+
+def disease_filters(compiled, kinds):
+    """(posting, exclude) filters of one compiled disease entry; 'not_for' postings exclude."""
+    return [(posting, kind == 'not_for') for kind in kinds for _, posting in compiled[kind]]
+
+def apply_disease_rows(rows, compiled, kinds, n_rows):
+    """
+    Apply the 'for' union and then the hard filters of one compiled disease entry.
+    As a set, the union narrows to the rows carrying any 'for' tag (falling back
+    when none does), so it joins the planned chain; its tag-by-tag row order is
+    applied to the survivors afterwards, which only ever lie all inside or all
+    outside that union.
+    """
+    union_rows = compiled['for_union']
+    rows = run_filters(rows, [(union_rows, False)] + disease_filters(compiled, kinds), n_rows)
+    if union_rows is not None and len(rows) and contains(union_rows, rows[:1])[0]:
+        rows = union_for_rows(rows, compiled['for'])
+    return rows
+
+def main_issue_rows(pet, rules):
+    """Rows left by the species, main issue and custom product stages, which only read species and main issue."""
+    rows = rules.postings(f"Species_{pet['species']}")
+    if rows is None or not len(rows):
+        rows = rules.all_rows
+    instrumentation.mark('species', rows)
+
+    # Store original rows before filtering for main issue
+    original_rows = rows
 
     # Filter by main issue (if any)
-    main_issue = df_pet_info.iloc[0]['main_issue'] 
-    if main_issue in disease_product_mapping:
-        disease_info = disease_product_mapping[main_issue]
+    main_issue = pet['main_issue']
+    if main_issue in rules.diseases:
+        compiled = rules.diseases[main_issue]
         logger.info(f"Filtering for main issue: {main_issue}")
-        df_filtered = filter_for_tags(df_filtered, disease_info)
-        df_filtered = filter_not_for_tags(df_filtered, disease_info)
-        df_filtered = filter_type_tags(df_filtered, disease_info)
-        df_filtered = filter_category_tags(df_filtered, disease_info)
-        df_filtered = filter_has_tags(df_filtered, disease_info)
+        rows = apply_disease_rows(rows, compiled, ['not_for', 'type', 'category', 'has'], rules.n_rows)
+        instrumentation.mark('main_issue', rows)
 
         # Check for custom products after main filtering
-        species = df_pet_info.iloc[0]['species'].lower()
-        custom_key = f"custom_{species}"
-        
-        if custom_key in disease_info and disease_info[custom_key]:
-            custom_products = disease_info[custom_key]
+        species = pet['species'].lower()
+        custom_rows = compiled.get(f"custom_{species}")
+
+        if custom_rows is not None:
             # Get products that were in original set but filtered out
-            removed_custom_products = [pid for pid in custom_products 
-                                     if pid in original_product_ids and pid not in df_filtered['Product_id'].values]
-            
-            if removed_custom_products:
+            removed_custom_rows = custom_rows[contains(original_rows, custom_rows) & ~np.isin(custom_rows, rows)]
+
+            if len(removed_custom_rows):
                 # Add back the custom products that were filtered out
-                custom_df = df_products[df_products['Product_id'].isin(removed_custom_products)]
+                rows = np.concatenate([rows, removed_custom_rows])
+                logger.info(f"Added back {len(removed_custom_rows)} custom products for {species}")
+        instrumentation.mark('custom_products', rows)
+    return rows
 
-                df_filtered = pd.concat([df_filtered, custom_df]).drop_duplicates()
-                logger.info(f"Added back {len(removed_custom_products)} custom products for {species}")
+def remaining_rows(pet, rules, rows):
+    """Apply the allergy, body score, pregnancy/lactation, life stage, other issue, breed size and activity stages."""
+    # Allergies, body score and pregnancy/lactation only drop rows, so they run as one planned chain
+    allergy_filters = []
+    body_score_filters = []
+    reproduction_filters = []
 
     # Filter by allergies
-    # if df_pet_info.iloc[0]['allergy'] == 1:
-    if df_pet_info.iloc[0]['allergy'] == 1:
-        for ingredient in df_pet_info.iloc[0]['allergic_to']:
-            if ingredient == 'unknown':
-                filter_by_condition(df_filtered, 'category_non-allergenic', 1)
-            else:
-                df_filtered = filter_by_condition(df_filtered, f'Ingredients_{ingredient}', 0)
+    if pet['allergy'] == 1:
+        # 'unknown' has never narrowed the result (its filter_by_condition result was discarded)
+        allergic_to = [ingredient for ingredient in pet['allergic_to'] if ingredient != 'unknown']
+        for column in rules.ingredients.columns_of(allergic_to):
+            allergy_filters.append((rules.postings(column), True))
 
     # Filter by body score
-    bds = df_pet_info.iloc[0]['body score (bds)']
+    bds = pet['body score (bds)']
     if bds >= 7: # >8 Means Obesity  and >7 Overweight
-        df_filtered = filter_by_condition(df_filtered, 'for_weight management', 1)
-        df_filtered = filter_by_condition(df_filtered, 'not_for_overweight', 0)
-        df_filtered = filter_by_condition(df_filtered, 'category_low calorie', 1)
+        body_score_filters.append((rules.postings('for_weight management'), False))
+        body_score_filters.append((rules.postings('not_for_overweight'), True))
+        body_score_filters.append((rules.postings('category_low calorie'), False))
 
     elif bds <= 3: # Means Underweight
-        df_filtered = filter_by_condition(df_filtered, 'for_weight management', 0)
-        df_filtered = filter_by_condition(df_filtered, 'for_appetite stimulation', 1)
-        df_filtered = filter_by_condition(df_filtered, 'not_for_underweight', 0)
-        df_filtered = filter_by_condition(df_filtered, 'not_for_catabolic states', 0)
-        df_filtered = filter_by_condition(df_filtered, 'category_high calorie', 1)
-        df_filtered = filter_by_condition(df_filtered, 'category_high protein', 1)
+        body_score_filters.append((rules.postings('for_weight management'), True))
+        body_score_filters.append((rules.postings('for_appetite stimulation'), False))
+        body_score_filters.append((rules.postings('not_for_underweight'), True))
+        body_score_filters.append((rules.postings('not_for_catabolic states'), True))
+        body_score_filters.append((rules.postings('category_high calorie'), False))
+        body_score_filters.append((rules.postings('category_high protein'), False))
 
     # Filter by pregnancy/lactation
-    if df_pet_info.iloc[0]['pregnant']:
+    if pet['pregnant']:
         life_stage = 'growth'
-        df_filtered = filter_by_condition(df_filtered, 'not_for_pregnancy', 0)
+        reproduction_filters.append((rules.postings('not_for_pregnancy'), True))
 
-    if df_pet_info.iloc[0]['lactating']:
+    if pet['lactating']:
         life_stage = 'growth'
-        df_filtered = filter_by_condition(df_filtered, 'not_for_lactation', 0)
+        reproduction_filters.append((rules.postings('not_for_lactation'), True))
+
+    rows = run_stages(rows, [('allergies', allergy_filters), ('body_score', body_score_filters),
+                             ('reproduction', reproduction_filters)], rules.n_rows)
 
     # Filter by life stage
-    if not (df_pet_info.iloc[0]['pregnant'] or df_pet_info.iloc[0]['lactating']):
-       life_stage = df_pet_info.iloc[0]['life_stage']
-    df_filtered = filter_life_stage(df_filtered, life_stage)
-    #print("rows after life_stage:",len(df_filtered))
+    if not (pet['pregnant'] or pet['lactating']):
+       life_stage = pet['life_stage']
+    rows = life_stage_rows(rows, rules.postings, life_stage)
+    instrumentation.mark('life_stage', rows)
 
     # Filter by other issues
-    if df_pet_info.iloc[0]['other_issues'] == 1:
-        for issue in df_pet_info.iloc[0]['other_issues_list']:
-            if issue in disease_product_mapping:
-                disease_info = disease_product_mapping[issue]
-                #print("Other_disease_info",disease_info)
-                df_filtered = filter_for_tags(df_filtered, disease_info)
-                df_filtered = filter_not_for_tags(df_filtered, disease_info)
-                df_filtered = filter_type_tags(df_filtered, disease_info)
-                df_filtered = filter_category_tags(df_filtered, disease_info)
+    if pet['other_issues'] == 1:
+        for issue in pet['other_issues_list']:
+            if issue in rules.diseases:
+                rows = apply_disease_rows(rows, rules.diseases[issue], ['not_for', 'type', 'category'], rules.n_rows)
+    instrumentation.mark('other_issues', rows)
 
     # Filter by breed size and activity level
-    df_filtered = filter_by_condition(df_filtered, f'breed_size_{df_pet_info.iloc[0]["breed_size"]}', 1)
-    # if df_pet_info['activity level'] == 'Active':
-    activity_level = df_pet_info.iloc[0]['activity level']
+    activity_filters = []
+    activity_level = pet['activity level']
     if activity_level == 'Active':
-        df_filtered = filter_by_condition(df_filtered, 'not_for_active pets', 0)
-        df_filtered = filter_by_condition(df_filtered, 'category_high calorie', 1)
-        if len(df_filtered)>=10:
-            df_filtered = filter_by_condition(df_filtered, 'category_energy-dense', 1)
+        activity_filters.append((rules.postings('not_for_active pets'), True))
+        activity_filters.append((rules.postings('category_high calorie'), False))
+
+    rows = run_stages(rows, [('breed_size', [(rules.postings(f'breed_size_{pet["breed_size"]}'), False)]),
+                             ('activity', activity_filters)], rules.n_rows, mark_last=False)
+    # Depends on how many rows are left, so it stays after the chain
+    if activity_level == 'Active' and len(rows)>=10:
+        rows = narrow_rows(rows, rules.postings('category_energy-dense'))
+    instrumentation.mark('activity', rows)
+
+    return rows
+
+def filter_product_rows(pet, rules):
+    """
+    Main filtering logic for pet products, as catalog row positions in result order.
+    Runs on the pet's species shard when the catalog has one.
+    """
+    shard = rules.species_shard(pet['species'])
+    if shard is not None:
+        return shard.rows[filter_product_rows(pet, shard)]
+    return remaining_rows(pet, rules, main_issue_rows(pet, rules))
+
+def table_key(pet, diseases):
+    """The pet fields filter_product_rows reads apart from allergies and other issues, canonicalised."""
+    pregnant, lactating = bool(pet['pregnant']), bool(pet['lactating'])
+    return (
+        pet['species'],
+        pet['main_issue'] if pet['main_issue'] in diseases else None,
+        body_score_band(pet['body score (bds)']),
+        pregnant,
+        lactating,
+        'growth' if (pregnant or lactating) else pet['life_stage'],
+        pet['breed_size'],
+        pet['activity level'] == 'Active',
+    )
+
+def residual_key(pet, diseases):
+    """
+    Allergies and other issues of a pet, canonicalised. Both keep their order:
+    their filter chains fall back, so order can change the result. Repeated
+    allergies and 'unknown' never do, and are dropped.
+    """
+    allergies = unique_in_order(a for a in pet['allergic_to'] if a != 'unknown') if pet['allergy'] == 1 else ()
+    other_issues = tuple(i for i in pet['other_issues_list'] if i in diseases) if pet['other_issues'] == 1 else ()
+    return allergies, other_issues
+
+def profile_key(pet, diseases):
+    """The pet fields filter_product_rows reads, canonicalised so that profiles with the same result share a key."""
+    return table_key(pet, diseases) + residual_key(pet, diseases)
+
+def materialize(pet, rules):
+    """Arrays a recommendation table stores for a profile without allergies or other issues."""
+    return {'rows': filter_product_rows(pet, rules)}
+
+def prefix_key(pet, diseases):
+    """Key of the main_issue_rows result, which only depends on species and main issue."""
+    return pet['species'], pet['main_issue'] if pet['main_issue'] in diseases else None
 
-    return df_filtered['Product_id'].tolist(),len(df_filtered)
+def materialize_prefix(pet, rules):
+    """Arrays a recommendation table stores for a species and main issue."""
+    return {'rows': main_issue_rows(pet, rules)}
 
+def table_rows(pet, rules, table):
+    """
+    Result rows from a materialized table: a direct lookup when the pet has no
+    allergies or other issues, else the stored main issue rows run through the
+    remaining stages. None when the table does not hold the pet's profile.
+    """
+    allergies, other_issues = residual_key(pet, rules.diseases)
+    if not (allergies or other_issues):
+        entry = table.get('full', table_key(pet, rules.diseases))
+        if entry is not None:
+            return entry['rows']
+    entry = table.get('prefix', prefix_key(pet, rules.diseases))
+    if entry is not None:
+        # Stored main issue rows are species rows, so they all lie in the species shard
+        shard = rules.species_shard(pet['species'])
+        if shard is not None:
+            return shard.rows[remaining_rows(pet, shard, shard.positions(entry['rows']))]
+        return remaining_rows(pet, rules, entry['rows'])
+    return None
 
-    
-    product_ids, count = filter_products(df_pet_info, df_products)
-    
-    # # Display the filtered products
-    # st.write(f"Pet Profile: {df_pet_info}")
-    st.write(f"Recommended Products: {product_ids}")
+def filter_products(df_pet_info, df_products, rules=None, cache=profile_cache, table=None):
+    """
+    Main filtering logic for pet products; results are served from `cache`
+    when it has them, else from a materialized recommendation `table` built
+    for the same catalog and rules.
+    """
+    if rules is None:
+        rules = get_compiled_rules(df_products, disease_product_mapping)
+    pet = df_pet_info.iloc[0]
+    if cache is not None:
+        key = profile_key(pet, rules.diseases)
+        cached = cache.get(key, rules.generation)
+        if cached is not None:
+            product_ids, count = cached
+            return list(product_ids), count
+    with instrumentation.request('v3'):
+        rows = None
+        if table is not None and table.serves(rules):
+            rows = table_rows(pet, rules, table)
+        if rows is None:
+            rows = filter_product_rows(pet, rules)
+        product_ids = rules.product_ids[rows].tolist()
+        instrumentation.mark('project', rows)
+    if cache is not None:
+        cache.put(key, rules.generation, (tuple(product_ids), len(rows)))
+    return product_ids,len(rows)
 
-    st.write("### Recommended Products:")
-    for _, row in recommended_products.iterrows():
-	    st.write(f"- {row['Product_Name']} (ID: {row['Product_ID']})")
 
 
 # def add_recommendations_to_pets(pet_info_df, df_products):
@@ -0,0 +1,238 @@
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from catalog import get_catalog
+from compiled_rules import get_compiled_rules
+from recommendation_table import NO_MAIN_ISSUE, engine_module, get_table
+from shared_catalog import SharedRules, attach_rules
+
+logger = logging.getLogger(__name__)
+
+# Pet CSV columns use the pet_info field names of the Streamlit apps
+REQUIRED_COLUMNS = ['species', 'life_stage', 'activity level', 'breed_size', 'body score (bds)']
+NO_BREED = '-- Select a breed --'
+# List cells are JSON lists (["chicken", "beef"]) or values separated by ; | or ,
+LIST_SEPARATORS = re.compile(r"[;|,]")
+TRUE_VALUES = {'1', '1.0', 'true', 'yes', 'y'}
+OUTPUT_FIELDS = ['row', 'pet_id', 'count', 'products', 'scores']
+
+
+def parse_list(value):
+    """Lower-cased, stripped items of a list cell; an empty cell is an empty list."""
+    text = value.strip()
+    if not text:
+        return []
+    items = json.loads(text) if text.startswith('[') else LIST_SEPARATORS.split(text)
+    return [str(item).strip().lower() for item in items if str(item).strip()]
+
+
+def parse_flag(value):
+    return value.strip().lower() in TRUE_VALUES
+
+
+def pet_profile(record):
+    """
+    pet_info dict for one CSV record (all values as strings), built the way the
+    Streamlit apps build it from the form: lower-cased choices, pregnancy and
+    lactation only for females, allergy and other-issue flags from the lists.
+    """
+    gender = record.get('gender', '').strip().lower()
+    other_issues_list = parse_list(record.get('other_issues_list', ''))
+    allergic_to = parse_list(record.get('allergic_to', ''))
+    weight = record.get('weight', '').strip()
+    age = record.get('age (months)', '').strip()
+    return {
+        "species": record['species'].strip().capitalize(),
+        "life_stage": record['life_stage'].strip().lower(),
+        "weight": float(weight) if weight else None,
+        "age (months)": int(float(age)) if age else None,
+        "activity level": record['activity level'].strip().lower(),
+        "main_issue": (record.get('main_issue', '').strip() or NO_MAIN_ISSUE).lower(),
+        "other_issues": 1 if other_issues_list else 0,
+        "other_issues_list": other_issues_list,
+        "gender": gender,
+        "breed": record.get('breed', '').strip() or NO_BREED,
+        "breed_size": record['breed_size'].strip().lower(),
+        "body score (bds)": float(record['body score (bds)']),
+        "pregnant": parse_flag(record.get('pregnant', '')) if gender == "female" else False,
+        "lactating": parse_flag(record.get('lactating', '')) if gender == "female" else False,
+        "allergy": int(bool(allergic_to)),
+        "allergic_to": allergic_to,
+    }
+
+
+def read_pet_chunks(path, chunk_size):
+    """Yield (first row number, records) for consecutive chunks of a pet CSV."""
+    reader = pd.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False)
+    start = 0
+    for chunk in reader:
+        missing = [column for column in REQUIRED_COLUMNS if column not in chunk.columns]
+        if missing:
+            raise ValueError(f"{path} is missing pet columns {missing}")
+        records = chunk.to_dict('records')
+        yield start, records
+        start += len(records)
+
+
+def score_chunk(engine, module, pets, catalog, rules, top_k=None, table=None):
+    """(Product_ids, scores or None, count) for each pet of a chunk."""
+    if engine == 'v5':
+        # Score as many pets at once as the engine's score matrix bound allows
+        batch_size = module.score_batch_size(rules)
+        results = []
+        for batch_start in range(0, len(pets), batch_size):
+            for products, count in module.recommend_records(pets[batch_start:batch_start + batch_size], rules, top_k):
+                results.append(([product_id for product_id, _ in products], [score for _, score in products], count))
+        return results
+    results = []
+    for pet in pets:
+        product_ids, count = module.filter_products(pd.DataFrame([pet]), catalog, rules=rules, table=table)
+        results.append((product_ids[:top_k] if top_k is not None else product_ids, None, count))
+    return results
+
+
+def output_format(path):
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def pet_profiles(pets_path, start, records):
+    """pet_info dicts of one chunk; a bad record is reported with its row number."""
+    pets = []
+    for i, record in enumerate(records):
+        try:
+            pets.append(pet_profile(record))
+        except (KeyError, ValueError) as error:
+            raise ValueError(f"{pets_path}: pet row {start + i}: {error}") from error
+    return pets
+
+
+def scored_chunks(pets_path, chunks, engine, catalog_path, top_k=None, table_path=None):
+    """Yield (first row number, records, results) for each chunk, scored in this process."""
+    module = engine_module(engine)
+    catalog = get_catalog(catalog_path)
+    rules = get_compiled_rules(catalog, module.disease_product_mapping)
+    table = get_table(table_path or f"recommendations_{engine}.npz")
+    for start, records in chunks:
+        pets = pet_profiles(pets_path, start, records)
+        yield start, records, score_chunk(engine, module, pets, catalog, rules, top_k, table)
+
+
+# Set in each pool worker by _init_worker: (engine, module, catalog, rules, top_k, table)
+_worker = None
+
+
+def _init_worker(handle, engine, top_k, table_path):
+    global _worker
+    logging.disable(logging.INFO)
+    module = engine_module(engine)
+    rules = attach_rules(handle, module.disease_product_mapping, text_columns=['Product_id'])
+    table = get_table(table_path or f"recommendations_{engine}.npz")
+    _worker = (engine, module, rules.catalog, rules, top_k, table)
+
+
+def _score_in_worker(pets_path, start, records):
+    engine, module, catalog, rules, top_k, table = _worker
+    return score_chunk(engine, module, pet_profiles(pets_path, start, records), catalog, rules, top_k, table)
+
+
+def scored_chunks_parallel(pets_path, chunks, engine, catalog_path, workers, top_k=None, table_path=None):
+    """
+    Yield (first row number, records, results) for each chunk, scored by a pool
+    of `workers` processes and yielded in input order. The catalog is loaded and
+    indexed once here and shared with the workers through shared memory; at most
+    two chunks per worker are in flight, so memory stays bounded.
+    """
+    module = engine_module(engine)
+    rules = get_compiled_rules(get_catalog(catalog_path), module.disease_product_mapping)
+    context = multiprocessing.get_context("spawn")
+    with SharedRules(rules) as shared:
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(shared.handle, engine, top_k, table_path)) as pool:
+            pending = deque()
+            for start, records in chunks:
+                pending.append((start, records, pool.submit(_score_in_worker, pets_path, start, records)))
+                if len(pending) >= 2 * workers:
+                    start, records, future = pending.popleft()
+                    yield start, records, future.result()
+            while pending:
+                start, records, future = pending.popleft()
+                yield start, records, future.result()
+
+
+def score_pets(pets_path, out_path, engine='v5', catalog_path='encoded_all_products.csv', chunk_size=10_000,
+               top_k=None, id_column='pet_id', table_path=None, workers=1):
+    """
+    Score every pet of a CSV file and write one result line per pet to `out_path`
+    (JSONL for a .jsonl path, CSV otherwise). The input is read and the output
+    written one chunk at a time, so memory does not grow with the number of pets.
+    With `workers` > 1, chunks are scored by that many processes sharing one catalog.
+    Returns a summary with the number of pets and the throughput.
+    """
+    fmt = output_format(out_path)
+    chunks = read_pet_chunks(pets_path, chunk_size)
+    if workers > 1:
+        scored = scored_chunks_parallel(pets_path, chunks, engine, catalog_path, workers, top_k, table_path)
+    else:
+        scored = scored_chunks(pets_path, chunks, engine, catalog_path, top_k, table_path)
+
+    started = time.perf_counter()
+    n_pets = 0
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=OUTPUT_FIELDS) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writeheader()
+        for start, records, results in scored:
+            for i, (record, (product_ids, scores, count)) in enumerate(zip(records, results)):
+                line = {'row': start + i, 'pet_id': record.get(id_column), 'count': count,
+                        'products': product_ids, 'scores': scores}
+                if writer is not None:
+                    line['products'] = ';'.join(product_ids)
+                    line['scores'] = '' if scores is None else ';'.join(map(str, scores))
+                    writer.writerow(line)
+                else:
+                    f.write(json.dumps(line) + '\n')
+            f.flush()
+            n_pets += len(records)
+            elapsed = time.perf_counter() - started
+            logger.info(f"Scored {n_pets} pets in {elapsed:.1f} s ({n_pets / elapsed:.0f} pets/s)")
+    os.replace(tmp_path, out_path)
+
+    elapsed = time.perf_counter() - started
+    return {
+        'engine': engine,
+        'workers': workers,
+        'pets': n_pets,
+        'seconds': round(elapsed, 3),
+        'pets_per_s': round(n_pets / elapsed, 1) if elapsed else None,
+        'output': out_path,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description="Score a CSV file of pet records with the v3 or V5 recommender.")
+    parser.add_argument("pets", help="pet CSV with pet_info columns (species, life_stage, main_issue, ...)")
+    parser.add_argument("-o", "--output", required=True, help="output .csv or .jsonl path")
+    parser.add_argument("--engine", choices=["v3", "v5"], default="v5")
+    parser.add_argument("--catalog", default="encoded_all_products.csv")
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="pets read, scored and written at a time")
+    parser.add_argument("--top-k", type=int, help="keep only the k best products per pet")
+    parser.add_argument("--id-column", default="pet_id", help="input column copied to the output as pet_id")
+    parser.add_argument("--table", help="materialized recommendation table (default: recommendations_<engine>.npz)")
+    parser.add_argument("--workers", type=int, default=1, help="scoring processes sharing one in-memory catalog")
+    args = parser.parse_args()
+    logger.setLevel(logging.INFO)
+    summary = score_pets(args.pets, args.output, args.engine, args.catalog, args.chunk_size, args.top_k,
+                         args.id_column, args.table, args.workers)
+    print(json.dumps(summary))
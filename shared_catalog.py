@@ -0,0 +1,185 @@
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from catalog import Catalog
+from compiled_rules import RULE_KINDS, CompiledRules, RulesShard, rules_version
+from tag_index import SparseTags, TagIndex
+
+logger = logging.getLogger(__name__)
+
+# Arrays in the shared block start on 64-byte boundaries, like the binary catalog sections
+BLOCK_ALIGN = 64
+
+
+def _aligned(offset):
+    return -(-offset // BLOCK_ALIGN) * BLOCK_ALIGN
+
+
+def _share_compiled(arrays, rules, prefix):
+    """
+    Add the postings and disease row sets of `rules` (a CompiledRules or a
+    shard) to `arrays` under `prefix`; returns the spec _attach_compiled reads.
+    Tag lists are rebuilt from the postings, 'for' unions and custom product rows are shared.
+    """
+    postings = [rules.postings(column) for column in rules.columns]
+    arrays[f"{prefix}postings"] = np.concatenate(postings).astype(np.int64) if postings else np.empty(0, dtype=np.int64)
+    arrays[f"{prefix}posting_offsets"] = np.concatenate([[0], np.cumsum([len(p) for p in postings])]).astype(np.int64)
+    diseases = {}
+    for disease, compiled in rules.diseases.items():
+        shared = {'missing': compiled['missing'], 'tags': {kind: [tag for tag, _ in compiled[kind]] for kind in RULE_KINDS},
+                  'arrays': {}}
+        for key, rows in compiled.items():
+            if key == 'for_union' or key.startswith('custom_'):
+                name = None if rows is None else f"{prefix}diseases.{len(arrays)}"
+                if name is not None:
+                    arrays[name] = np.asarray(rows, dtype=np.int64)
+                shared['arrays'][key] = name
+        diseases[disease] = shared
+    return {'prefix': prefix, 'n_rows': rules.n_rows, 'diseases': diseases}
+
+
+def _attach_compiled(spec, columns, view, share_diseases):
+    """(TagIndex, compiled diseases or None) over the shared arrays of a _share_compiled spec."""
+    prefix = spec['prefix']
+    postings, offsets = view(f"{prefix}postings"), view(f"{prefix}posting_offsets")
+    index = TagIndex.from_postings(spec['n_rows'], {
+        column: postings[offsets[j]:offsets[j + 1]] for j, column in enumerate(columns)
+    })
+    if not share_diseases:
+        return index, None
+    diseases = {}
+    for disease, shared in spec['diseases'].items():
+        compiled = {'missing': shared['missing']}
+        for kind, tags in shared['tags'].items():
+            compiled[kind] = [(tag, index.postings(tag)) for tag in tags]
+        for key, name in shared['arrays'].items():
+            compiled[key] = None if name is None else view(name)
+        diseases[disease] = compiled
+    return index, diseases
+
+
+class SharedRules:
+    """
+    Compiled rules copied once into a shared memory block: the catalog arrays
+    (tag matrix, tag postings, Product_id ranks, product strings, deleted rows), the row
+    sets of every compiled disease, and the same for each species shard.
+    Worker processes attach to `handle` with attach_rules and get rules over
+    views of the block instead of loading, indexing and compiling their own
+    copy of the catalog.
+
+    The creating process owns the block: use it as a context manager, or call
+    close() once every worker is done.
+    """
+
+    def __init__(self, rules):
+        catalog = rules.catalog
+        arrays = {
+            'product_id_rank': np.ascontiguousarray(rules.product_id_rank, dtype=np.int64),
+            'dead': np.asarray(rules.dead, dtype=np.int64),
+        }
+        # A sparse catalog's tags are rebuilt from the shared postings, so only a dense one ships its matrix
+        if not catalog.sparse:
+            arrays['matrix'] = np.asfortranarray(rules.matrix, dtype=np.uint8)
+        for column, values in catalog.strings.items():
+            arrays[f"strings.{column}"] = np.frombuffer('\0'.join(values).encode('utf-8'), dtype=np.uint8)
+        compiled = _share_compiled(arrays, rules, '')
+        shards = {}
+        for i, (species, shard) in enumerate(rules.shards.items()):
+            prefix = f"shards.{i}."
+            arrays[f"{prefix}rows"] = np.asarray(shard.rows, dtype=np.int64)
+            arrays[f"{prefix}dead"] = np.asarray(shard.dead, dtype=np.int64)
+            shards[species] = _share_compiled(arrays, shard, prefix)
+
+        layout = {}
+        size = 0
+        for name, values in arrays.items():
+            layout[name] = [size, values.dtype.str, list(values.shape)]
+            size = _aligned(size + values.nbytes)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, values in arrays.items():
+            offset, dtype, shape = layout[name]
+            view = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset, order='F')
+            view[...] = values
+            del view
+        self.nbytes = size
+        # The generation travels with the block so worker results match the parent's cache keys
+        self.handle = {
+            'name': self._shm.name,
+            'layout': layout,
+            'n_rows': rules.n_rows,
+            'columns': list(rules.columns),
+            'column_order': list(catalog.column_order),
+            'text_columns': list(catalog.strings),
+            'sparse': catalog.sparse,
+            'version': rules.generation[0],
+            'rules_version': rules.rules_version,
+            'compiled': compiled,
+            'shards': shards,
+        }
+        logger.info(f"Shared {rules.n_rows} products ({size / 1e6:.1f} MB) as {self._shm.name}")
+
+    def close(self):
+        """Release and remove the block; workers must no longer use it."""
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Blocks attached by this process, kept open for as long as the process uses their views
+_attached = {}
+
+
+def attach_rules(handle, disease_product_mapping, text_columns=None):
+    """
+    Rules for `disease_product_mapping` over the shared arrays described by a
+    SharedRules handle. The compiled diseases are shared too when the block was
+    made from the same rule table; otherwise they are compiled here. String
+    columns are decoded into this process, so only `text_columns` are (all by
+    default; scoring needs only Product_id).
+    """
+    shm = _attached.get(handle['name'])
+    if shm is None:
+        # Workers started by multiprocessing share the creator's resource tracker, so
+        # attaching does not make the block go away when a worker exits
+        shm = shared_memory.SharedMemory(name=handle['name'])
+        _attached[handle['name']] = shm
+
+    def view(name):
+        offset, dtype, shape = handle['layout'][name]
+        values = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset, order='F')
+        values.setflags(write=False)
+        return values
+
+    n_rows = handle['n_rows']
+    strings = {}
+    for column in handle['text_columns']:
+        if text_columns is None or column in text_columns or column == 'Product_id':
+            text = view(f"strings.{column}").tobytes().decode('utf-8')
+            strings[column] = np.array(text.split('\0') if n_rows else [], dtype=object)
+    column_order = [column for column in handle['column_order'] if column in strings or column in handle['columns']]
+    if handle['sparse']:
+        spec = handle['compiled']
+        matrix = SparseTags(n_rows, view(f"{spec['prefix']}posting_offsets"), view(f"{spec['prefix']}postings"))
+    else:
+        matrix = view('matrix')
+    catalog = Catalog(column_order, handle['columns'], matrix, strings, handle['version'], dead=view('dead'))
+
+    # Disease row sets are only valid for the rule table the block was made from
+    share_diseases = handle['rules_version'] == rules_version(disease_product_mapping)
+    index, diseases = _attach_compiled(handle['compiled'], handle['columns'], view, share_diseases)
+    rules = CompiledRules(catalog, disease_product_mapping, index=index, product_id_rank=view('product_id_rank'),
+                          diseases=diseases, shards={})
+    for species, spec in handle['shards'].items():
+        index, diseases = _attach_compiled(spec, handle['columns'], view, share_diseases)
+        rules.shards[species] = RulesShard(rules, view(f"{spec['prefix']}rows"), disease_product_mapping,
+                                           index=index, diseases=diseases, dead=view(f"{spec['prefix']}dead"))
+    return rules
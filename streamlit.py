@@ -1,9 +1,12 @@
 import streamlit as st
 import pandas as pd
 from rule_based_v3_streamlit import disease_product_mapping, filter_products, filter_by_condition, filter_for_tags, filter_not_for_tags, filter_type_tags, filter_category_tags, filter_has_tags, filter_life_stage
+from catalog import get_catalog
+from recommendation_table import get_table
 
-# Load product data
-df_products = pd.read_csv("encoded_all_products.csv")
+# Load product data once per process; reruns reuse it until the file changes
+catalog = get_catalog("encoded_all_products.csv")
+df_products = catalog.frame()
 #df_productdata = pd.read_csv("Products_final_cleaned.csv")
 
 
@@ -233,7 +236,7 @@ if submitted:
         st.write("### Pet Information Summary")
         st.json(pet_info)
         # Here we would call recommendation function
-        product_ids, count = filter_products(df_pet_info, df_products)
+        product_ids, count = filter_products(df_pet_info, catalog, table=get_table("recommendations_v3.npz"))
         recommended_products = df_products[df_products['Product_id'].isin(product_ids)]
                 
         # Display would look like:
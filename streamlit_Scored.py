@@ -1,9 +1,11 @@
 import streamlit as st
 import pandas as pd
 from rule_based_v5_scored import filter_products
+from catalog import get_catalog
 
-# Load product data
-df_products = pd.read_csv("encoded_all_products.csv")
+# Load product data once per process; reruns reuse it until the file changes
+catalog = get_catalog("encoded_all_products.csv")
+df_products = catalog.frame()
 #df_productdata = pd.read_csv("Products_final_cleaned.csv")
 
 
@@ -233,22 +235,20 @@ if submitted:
         st.write("### Pet Information Summary")
         st.json(pet_info)
         # Here we would call recommendation function
-        df_products['Score'] = 0
-        scored_product_ids, count = filter_products(df_pet_info, df_products)
+        # Scores are computed per request; the shared catalog frame is never written to
+        scored_product_ids, count = filter_products(df_pet_info, catalog)
 
         # Create DataFrame of recommended products with their scores
         recommended_df = pd.DataFrame(scored_product_ids, columns=['Product_id', 'Score'])
         # Merge with product details
         recommended_products = pd.merge(
             recommended_df,
-            df_products.drop(columns=['Score']), 
+            df_products,
             on='Product_id',
             how='left'
         )
 
-        # Sort by score
-        recommended_products = recommended_products.sort_values('Score', ascending=False)
-
+        # The engine already ranks products and a left merge keeps that order
         # Display would look like:
         st.write("## Recommended Products:")
         st.write("#### No. of Recommended Products:",count)
@@ -0,0 +1,169 @@
+import argparse
+import logging
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from catalog import CATALOG_SUFFIX, file_version, write_catalog_chunks
+
+logger = logging.getLogger(__name__)
+
+# Tag groups resampled as a block from a real product of the same kind, which keeps
+# the co-occurrences inside each group (e.g. for_kidney health with not_for_pregnancy)
+TAG_GROUPS = ["for_", "not_for_", "category_", "has_", "Ingredients_"]
+# Fewest real products sharing a key block before donors fall back to brand + species
+MIN_DONORS = 3
+PRODUCT_ID_PATTERN = re.compile(r"^(.*_)P(\d+)$")
+
+
+def tag_group(column):
+    """
+    Tag group a numeric column belongs to, or None for key columns (Species,
+    Type, life_stage, breed_size, AAFCO, complete_and_balanced), which describe
+    what a product is and are always taken together from one real product.
+    """
+    # not_for_ must be tested before for_
+    for prefix in sorted(TAG_GROUPS, key=len, reverse=True):
+        if column.startswith(prefix):
+            return prefix
+    return None
+
+
+class CatalogModel:
+    """
+    Per-column frequencies and co-occurrences learned from a real encoded catalog.
+
+    A synthetic product draws its key block (species, type, life stage, breed
+    size, AAFCO, brand, names) from one real product, then draws every tag
+    group from a real product with the same brand and key block (or from the
+    rarer key blocks of the same brand and species when fewer than MIN_DONORS
+    share it). Each column keeps
+    its real frequency and each group keeps its real co-occurrences, while
+    products are new combinations rather than copies.
+    """
+
+    def __init__(self, df_products):
+        self.column_order = df_products.columns.tolist()
+        self.columns = df_products.select_dtypes('number').columns.tolist()
+        self.float_columns = set(df_products.select_dtypes('float').columns)
+        self.text_columns = [column for column in self.column_order if column not in self.columns]
+        self.matrix = df_products[self.columns].to_numpy(dtype=np.uint8)
+        self.strings = {column: df_products[column].fillna('').to_numpy(dtype=object) for column in self.text_columns}
+        self.frequencies = self.matrix.mean(axis=0) if len(self.matrix) else np.zeros(len(self.columns))
+
+        groups = [tag_group(column) for column in self.columns]
+        self.group_columns = {
+            group: np.array([j for j, g in enumerate(groups) if g == group], dtype=np.intp) for group in TAG_GROUPS
+        }
+
+        # Product_id prefix (brand and species code) of each real product, e.g. "RC_C_"
+        self.id_prefixes = np.array([self._id_prefix(product_id) for product_id in self.strings['Product_id']], dtype=object)
+        key_columns = [j for j, g in enumerate(groups) if g is None]
+        brand = self.strings.get('Brand', self.id_prefixes)
+        strata = pd.Series(list(zip(brand, map(bytes, self.matrix[:, key_columns]))))
+        # Key blocks shared by fewer than MIN_DONORS products pool together per Product_id
+        # prefix. Pools partition the catalog, so every real product is an equally likely
+        # donor and column frequencies are preserved.
+        small = strata.map(strata.value_counts()) < MIN_DONORS
+        pool_keys = strata.where(~small, pd.Series(self.id_prefixes))
+        pool_codes = pd.factorize(pool_keys)[0]
+        pool_of = [np.flatnonzero(pool_codes == code) for code in range(pool_codes.max(initial=-1) + 1)]
+        # Donor pools per real product, flattened into (offsets, lengths, rows) for vectorised draws
+        pools = [pool_of[code] for code in pool_codes]
+        self.pool_lengths = np.array([len(pool) for pool in pools], dtype=np.intp)
+        self.pool_offsets = np.concatenate([[0], np.cumsum(self.pool_lengths)[:-1]]).astype(np.intp)
+        self.pool_rows = np.concatenate(pools) if pools else np.empty(0, dtype=np.intp)
+
+    @staticmethod
+    def _id_prefix(product_id):
+        match = PRODUCT_ID_PATTERN.match(product_id)
+        if match is None:
+            raise ValueError(f"Product_id {product_id!r} does not follow the <BRAND>_<SPECIES>_P<n> convention")
+        return match.group(1)
+
+    def sample(self, n_rows, rng):
+        """Draw `n_rows` synthetic products as (matrix, {text column: values}, Product_id prefixes)."""
+        key_rows = rng.integers(len(self.matrix), size=n_rows)
+        matrix = self.matrix[key_rows]
+        for columns in self.group_columns.values():
+            if not len(columns):
+                continue
+            picks = (rng.random(n_rows) * self.pool_lengths[key_rows]).astype(np.intp)
+            donors = self.pool_rows[self.pool_offsets[key_rows] + picks]
+            matrix[:, columns] = self.matrix[np.ix_(donors, columns)]
+        strings = {column: values[key_rows] for column, values in self.strings.items()}
+        return matrix, strings, self.id_prefixes[key_rows]
+
+
+def generate_chunks(model, n_rows, seed=0, chunk_size=100_000):
+    """Yield (matrix, strings) chunks of a synthetic catalog with fresh, unique Product_ids."""
+    rng = np.random.default_rng(seed)
+    # Product numbers continue per Product_id prefix across chunks: H_D_P01, H_D_P02, ...
+    next_number = {}
+    for start in range(0, n_rows, chunk_size):
+        matrix, strings, prefixes = model.sample(min(chunk_size, n_rows - start), rng)
+        product_ids = np.empty(len(prefixes), dtype=object)
+        for prefix in pd.unique(prefixes):
+            rows = np.flatnonzero(prefixes == prefix)
+            first = next_number.get(prefix, 1)
+            product_ids[rows] = [f"{prefix}P{number:02d}" for number in range(first, first + len(rows))]
+            next_number[prefix] = first + len(rows)
+        strings['Product_id'] = product_ids
+        yield matrix, strings
+
+
+def write_synthetic_csv(model, chunks, out_path):
+    """Stream chunks to an encoded products CSV with the real schema; returns column sums."""
+    totals = np.zeros(len(model.columns), dtype=np.int64)
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, 'w', newline='') as f:
+        for i, (matrix, strings) in enumerate(chunks):
+            totals += matrix.sum(axis=0, dtype=np.int64)
+            data = {column: strings[column] for column in model.text_columns}
+            for j, column in enumerate(model.columns):
+                data[column] = matrix[:, j].astype(np.float64 if column in model.float_columns else np.int64)
+            pd.DataFrame(data, columns=model.column_order).to_csv(f, header=i == 0, index=False)
+    os.replace(tmp_path, out_path)
+    return totals
+
+
+def generate_catalog(csv_path, out_path, n_rows, seed=0, chunk_size=100_000):
+    """
+    Write a synthetic catalog of `n_rows` products learned from `csv_path`.
+    The output is a CSV or, for a .ovcat path, a binary catalog.
+    """
+    model = CatalogModel(pd.read_csv(csv_path))
+    chunks = generate_chunks(model, n_rows, seed, chunk_size)
+    if out_path.endswith(CATALOG_SUFFIX):
+        totals = np.zeros(len(model.columns), dtype=np.int64)
+
+        def counted(chunks):
+            for matrix, strings in chunks:
+                totals[:] += matrix.sum(axis=0, dtype=np.int64)
+                yield matrix, strings
+
+        version = f"synthetic-{n_rows}-{seed}-{file_version(csv_path)}"
+        write_catalog_chunks(out_path, model.column_order, model.columns, n_rows, counted(chunks), version)
+    else:
+        totals = write_synthetic_csv(model, chunks, out_path)
+
+    if n_rows and len(model.columns):
+        drift = np.abs(totals / n_rows - model.frequencies)
+        worst = int(np.argmax(drift))
+        logger.info(f"Wrote {n_rows} synthetic products to {out_path}; largest column frequency drift "
+                    f"{drift[worst]:.4f} ({model.columns[worst]})")
+    return out_path
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Generate a synthetic encoded product catalog from the real one.")
+    parser.add_argument("n_rows", type=int)
+    parser.add_argument("-o", "--output", required=True, help=f"output .csv or {CATALOG_SUFFIX} path")
+    parser.add_argument("--source", default="encoded_all_products.csv")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    args = parser.parse_args()
+    generate_catalog(args.source, args.output, args.n_rows, args.seed, args.chunk_size)
@@ -0,0 +1,176 @@
+import numpy as np
+
+# Posting lists are sorted arrays of catalog row positions. Candidate row sets
+# passed to these helpers may be in any order (the v3 'for' union reorders
+# rows); results keep the order of the candidates.
+
+
+def contains(posting, rows):
+    """Boolean array telling which of `rows` appear in the sorted `posting`."""
+    if not len(posting) or not len(rows):
+        return np.zeros(len(rows), dtype=bool)
+    positions = np.minimum(np.searchsorted(posting, rows), len(posting) - 1)
+    return posting[positions] == rows
+
+
+def intersect(rows, posting):
+    """`rows` that appear in `posting`, in `rows` order."""
+    return rows[contains(posting, rows)]
+
+
+def difference(rows, posting):
+    """`rows` that do not appear in `posting`, in `rows` order."""
+    return rows[~contains(posting, rows)]
+
+
+def match_positions(values, posting):
+    """
+    Ascending positions in sorted `values` of the entries also in sorted
+    `posting`; the cost follows the smaller of the two arrays.
+    """
+    if len(posting) < len(values):
+        positions = np.searchsorted(values, posting)
+        found = positions < len(values)
+        positions = positions[found]
+        return positions[values[positions] == posting[found]]
+    return np.flatnonzero(contains(posting, values))
+
+
+def union(postings):
+    """Sorted union of several posting lists."""
+    postings = [posting for posting in postings if len(posting)]
+    if not postings:
+        return np.empty(0, dtype=np.intp)
+    if len(postings) == 1:
+        return postings[0]
+    return np.unique(np.concatenate(postings))
+
+
+class TagIndex:
+    """Inverted index from every tag column to the sorted rows where it is 1."""
+
+    def __init__(self, matrix, columns):
+        self.n_rows = matrix.shape[0]
+        self._postings = {}
+        for j, column in enumerate(columns):
+            posting = np.flatnonzero(matrix[:, j] == 1)
+            posting.setflags(write=False)
+            self._postings[column] = posting
+
+    @classmethod
+    def from_postings(cls, n_rows, postings):
+        """Index over already built {column: sorted rows} postings, e.g. views of shared memory."""
+        index = cls.__new__(cls)
+        index.n_rows = n_rows
+        index._postings = dict(postings)
+        return index
+
+    def updated(self, n_rows, postings):
+        """Index over `n_rows` rows with the given columns' postings replaced; the others are shared."""
+        return TagIndex.from_postings(n_rows, {**self._postings, **postings})
+
+    def postings(self, column):
+        """Sorted rows where `column` is 1, or None if the catalog has no such column."""
+        return self._postings.get(column)
+
+
+# Cost of looking a row up in a posting list by binary search, relative to touching one mask row
+SPARSE_SEARCH_COST = 16
+
+
+def index_dtype(n_rows):
+    """Smallest integer type for row positions of a table of `n_rows` rows."""
+    return np.int32 if n_rows < 2 ** 31 else np.int64
+
+
+class SparseTags:
+    """
+    0/1 tag matrix stored column by column (CSC without values): column j is
+    1 exactly at the sorted rows `indices[indptr[j]:indptr[j + 1]]`. These
+    are the posting lists, so a TagIndex over them needs no copy, and memory
+    follows the number of 1s instead of rows x columns.
+    """
+
+    def __init__(self, n_rows, indptr, indices):
+        self.n_rows = n_rows
+        self.indptr = indptr
+        self.indices = indices
+        self.shape = (n_rows, len(indptr) - 1)
+        self.nbytes = indptr.nbytes + indices.nbytes
+        self.indptr.setflags(write=False)
+        self.indices.setflags(write=False)
+
+    @classmethod
+    def from_dense(cls, matrix):
+        """Sparse copy of a dense 0/1 matrix (which may be a memmap, read one column at a time)."""
+        n_rows, n_columns = matrix.shape
+        counts = [np.count_nonzero(matrix[:, j]) for j in range(n_columns)]
+        indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        indices = np.empty(indptr[-1], dtype=index_dtype(n_rows))
+        for j in range(n_columns):
+            indices[indptr[j]:indptr[j + 1]] = np.flatnonzero(matrix[:, j])
+        return cls(n_rows, indptr, indices)
+
+    @classmethod
+    def from_postings(cls, n_rows, postings):
+        """Tags with column j 1 at the sorted rows `postings[j]`."""
+        indptr = np.concatenate([[0], np.cumsum([len(posting) for posting in postings])]).astype(np.int64)
+        indices = np.empty(indptr[-1], dtype=index_dtype(n_rows))
+        for j, posting in enumerate(postings):
+            indices[indptr[j]:indptr[j + 1]] = posting
+        return cls(n_rows, indptr, indices)
+
+    @classmethod
+    def stacked(cls, parts):
+        """Tags of several row blocks (SparseTags with the same columns) one after the other."""
+        starts = np.cumsum([0] + [part.n_rows for part in parts])
+        n_columns = parts[0].shape[1] if parts else 0
+        return cls.from_postings(int(starts[-1]), [
+            np.concatenate([part.column(j).astype(np.int64) + start for part, start in zip(parts, starts)])
+            for j in range(n_columns)
+        ])
+
+    def column(self, j):
+        """Sorted rows where column j is 1."""
+        return self.indices[self.indptr[j]:self.indptr[j + 1]]
+
+    def columns(self):
+        return [self.column(j) for j in range(self.shape[1])]
+
+    def features(self, active, rows=None):
+        """Dense uint8 block of columns `active` over all rows or only `rows`, built from the nonzeros only."""
+        if rows is None:
+            features = np.zeros((self.n_rows, len(active)), dtype=np.uint8)
+            for i, j in enumerate(active):
+                features[self.column(j), i] = 1
+            return features
+        features = np.empty((len(rows), len(active)), dtype=np.uint8)
+        if len(rows) * SPARSE_SEARCH_COST < self.n_rows:
+            for i, j in enumerate(active):
+                features[:, i] = contains(self.column(j), rows)
+            return features
+        # Many rows: mark each column in one reused row mask and read it at `rows`
+        mask = np.zeros(self.n_rows, dtype=bool)
+        for i, j in enumerate(active):
+            column = self.column(j)
+            mask[column] = True
+            features[:, i] = mask[rows]
+            mask[column] = False
+        return features
+
+    def toarray(self):
+        """Dense column-major copy."""
+        return np.asfortranarray(self.features(np.arange(self.shape[1])))
+
+    def with_rows(self, n_rows, rows, values):
+        """Tags over `n_rows` rows (at least as many as now) with sorted `rows` set to the 0/1 rows of `values`."""
+        postings = []
+        for j in range(self.shape[1]):
+            posting = difference(self.column(j), rows)
+            added = rows[values[:, j] == 1]
+            postings.append(np.insert(posting, np.searchsorted(posting, added), added))
+        return SparseTags.from_postings(n_rows, postings)
+
+    def take(self, rows):
+        """Tags of the sorted `rows` only, renumbered from 0."""
+        return SparseTags.from_postings(len(rows), [match_positions(rows, self.column(j)) for j in range(self.shape[1])])
@@ -0,0 +1,38 @@
+import gc
+import os
+import sys
+import weakref
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import load_catalog
+from catalog_updates import LiveCatalog
+from compiled_rules import get_compiled_rules
+from recommendation_table import engine_module
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "encoded_all_products.csv")
+
+
+def flipped_product(catalog, j):
+    """The first product of `catalog` with tag column `j` flipped, as an upsert frame."""
+    df = catalog.frame().head(1).copy()
+    column = catalog.columns[j]
+    df[column] = 1 - df[column]
+    return df
+
+
+def test_update_releases_previous_snapshot():
+    mapping = engine_module("v5").disease_product_mapping
+    live = LiveCatalog(load_catalog(CATALOG_PATH))
+    get_compiled_rules(live.catalog, mapping)
+    snapshots = [weakref.ref(live.catalog)]
+    for j in range(5):
+        live.upsert(flipped_product(live.catalog, j))
+        snapshots.append(weakref.ref(live.catalog))
+    gc.collect()
+
+    assert [ref() is not None for ref in snapshots] == [False] * 5 + [True]
+    # The current snapshot keeps the rules the update registered for it
+    rules = get_compiled_rules(live.catalog, mapping)
+    assert rules.catalog is live.catalog
+    assert live.catalog.compiled_rules == {id(mapping): rules}
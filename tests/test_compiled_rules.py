@@ -0,0 +1,34 @@
+import gc
+import os
+import shutil
+import sys
+import weakref
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import get_catalog
+from compiled_rules import get_compiled_rules
+from recommendation_table import engine_module
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "encoded_all_products.csv")
+
+
+def test_reloaded_catalog_releases_previous_catalog_and_rules(tmp_path):
+    mapping = engine_module("v5").disease_product_mapping
+    path = str(tmp_path / "products.csv")
+    shutil.copy(CATALOG_PATH, path)
+    old_catalog = get_catalog(path)
+    old = weakref.ref(old_catalog)
+    old_rules = weakref.ref(get_compiled_rules(old_catalog, mapping))
+    del old_catalog
+
+    # Drop a product, so the size (and with it the load stamp) changes
+    pd.read_csv(path).iloc[:-1].to_csv(path, index=False)
+    catalog = get_catalog(path)
+    gc.collect()
+
+    assert catalog is not old()
+    assert old() is None and old_rules() is None
+    assert get_compiled_rules(catalog, mapping).n_rows == catalog.n_rows